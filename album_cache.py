@@ -0,0 +1,63 @@
+"""
+In-memory Qobuz album details (album payload + track list) by album id, so
+the web UI's selection, release matching, download and tagging steps share
+one fetch instead of each carrying parts of it through the session or
+asking the API again.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from qobuz_api import get_album_details
+
+class AlbumDetailsCache:
+    """Qobuz album id -> (album_data, tracks), LRU-bounded to max_albums and refreshed after ttl seconds."""
+    def __init__(self, max_albums=None, ttl=None):
+        self.max_albums = max_albums or config.ALBUM_CACHE_MAX_ENTRIES
+        self.ttl = ttl if ttl is not None else config.ALBUM_CACHE_TTL
+        self._albums = OrderedDict()  # album id -> (fetched at, album_data, tracks)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def peek(self, album_id):
+        """Cached (album_data, tracks), or None without fetching."""
+        key = str(album_id)
+        with self._lock:
+            entry = self._albums.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            self._albums.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def get(self, album_id):
+        """(album_data, tracks) for an album, fetching it on a miss; (None, []) if Qobuz can't provide it."""
+        cached = self.peek(album_id)
+        if cached:
+            return cached
+        album_data, tracks = get_album_details(album_id)
+        with self._lock:
+            self.misses += 1
+            if album_data is not None:  # failures are retried next time
+                self._albums[str(album_id)] = (time.time(), album_data, tracks)
+                self._albums.move_to_end(str(album_id))
+                while len(self._albums) > self.max_albums:
+                    self._albums.popitem(last=False)
+        return album_data, tracks
+
+    def stats(self):
+        with self._lock:
+            return {"albums": len(self._albums), "hits": self.hits, "misses": self.misses}
+
+_album_cache = None
+_album_cache_lock = threading.Lock()
+
+def get_album_cache():
+    """Returns the process-wide album details cache."""
+    global _album_cache
+    with _album_cache_lock:
+        if _album_cache is None:
+            _album_cache = AlbumDetailsCache()
+        return _album_cache
@@ -0,0 +1,72 @@
+"""
+Benchmark: per-track aiohttp sessions vs. one pooled session per job.
+Serves fake tracks from a local aiohttp server and counts how many TCP
+connections each strategy opens (each one is a TLS handshake against the real CDN).
+
+Usage: python bench_downloads.py [tracks] [track_size_kb]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from aiohttp import web
+
+import config
+from downloader import download_music_async, create_download_session
+
+TRACKS = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+TRACK_SIZE = (int(sys.argv[2]) if len(sys.argv) > 2 else 512) * 1024
+
+async def start_server(connections):
+    payload = os.urandom(TRACK_SIZE)
+
+    async def track(request):
+        connections.add(request.transport.get_extra_info("peername"))
+        return web.Response(body=payload, content_type="audio/flac")
+
+    app = web.Application()
+    app.router.add_get("/track/{n}", track)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+async def per_track_sessions(base_url, target_dir):
+    await asyncio.gather(*(
+        download_music_async(f"{base_url}/track/{n}", f"track{n}.flac", target_directory=target_dir)
+        for n in range(TRACKS)
+    ))
+
+async def pooled_session(base_url, target_dir):
+    semaphore = asyncio.Semaphore(config.DOWNLOAD_CONCURRENCY)
+
+    async def bounded(session, n):
+        async with semaphore:
+            await download_music_async(f"{base_url}/track/{n}", f"track{n}.flac", target_directory=target_dir, session=session)
+
+    async with create_download_session() as session:
+        await asyncio.gather(*(bounded(session, n) for n in range(TRACKS)))
+
+async def run(name, strategy):
+    connections = set()
+    runner, base_url = await start_server(connections)
+    try:
+        with tempfile.TemporaryDirectory() as target_dir:
+            start = time.perf_counter()
+            await strategy(base_url, target_dir)
+            elapsed = time.perf_counter() - start
+    finally:
+        await runner.cleanup()
+    mb = TRACKS * TRACK_SIZE / (1024 * 1024)
+    print(f"{name:<22} {len(connections):>4} connections  {elapsed:6.2f}s  {mb / elapsed:8.1f} MB/s")
+
+async def main():
+    print(f"{TRACKS} tracks x {TRACK_SIZE // 1024} KB, concurrency={config.DOWNLOAD_CONCURRENCY}")
+    await run("per-track sessions", per_track_sessions)
+    await run("pooled session", pooled_session)
+
+if __name__ == "__main__":
+    asyncio.run(main())
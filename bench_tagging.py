@@ -0,0 +1,69 @@
+"""
+Benchmark: per-file tag write time of the table-driven writer for each container.
+Encodes a one-second silent file per format with ffmpeg, copies it N times and
+times write_tag_fields (open, clear, fill from TAG_FIELDS, cover, save) on each copy.
+
+Usage: python bench_tagging.py [files_per_format]
+"""
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from tag_writer import TAG_FIELDS, write_tag_fields
+
+FILES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+# (extension, tag format, ffmpeg encoder arguments)
+FORMATS = [
+    ("flac", "vorbis", ["-c:a", "flac"]),
+    ("mp3", "id3", ["-c:a", "libmp3lame", "-b:a", "320k"]),
+    ("m4a", "mp4", ["-c:a", "aac", "-b:a", "256k"]),
+    ("opus", "vorbis", ["-c:a", "libopus", "-b:a", "128k"]),
+]
+
+METADATA = {field: f"Benchmark {field}" for field in TAG_FIELDS}
+METADATA.update(tracknumber="3", totaltracks="12", discnumber="1", totaldiscs="1", artists=["Artist One", "Artist Two"])
+COVER = os.urandom(60 * 1024)  # roughly a 500px JPEG
+
+def make_source(target_dir, ext, encoder_args):
+    path = os.path.join(target_dir, f"source.{ext}")
+    result = subprocess.run(
+        ["ffmpeg", "-y", "-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo", "-t", "1", *encoder_args, path],
+        capture_output=True
+    )
+    return path if result.returncode == 0 else None
+
+def run(target_dir, ext, tag_format, encoder_args):
+    source = make_source(target_dir, ext, encoder_args)
+    if not source:
+        print(f"{ext:>5}: skipped (ffmpeg can't encode it here)")
+        return
+    paths = []
+    for n in range(FILES):
+        path = os.path.join(target_dir, f"track{n}.{ext}")
+        shutil.copyfile(source, path)
+        paths.append(path)
+
+    timings = []
+    start = time.perf_counter()
+    for path in paths:
+        file_start = time.perf_counter()
+        write_tag_fields(path, METADATA, COVER, tag_format)
+        timings.append(time.perf_counter() - file_start)
+    elapsed = time.perf_counter() - start
+
+    timings.sort()
+    print(f"{ext:>5}: {FILES} files in {elapsed:.2f}s | "
+          f"mean {statistics.mean(timings) * 1000:.2f} ms | "
+          f"p50 {timings[len(timings) // 2] * 1000:.2f} ms | "
+          f"p95 {timings[int(len(timings) * 0.95)] * 1000:.2f} ms per file")
+
+if __name__ == "__main__":
+    print(f"Tag write benchmark: {len(TAG_FIELDS)} fields + {len(COVER) // 1024} KB cover per file")
+    for ext, tag_format, encoder_args in FORMATS:
+        with tempfile.TemporaryDirectory() as target_dir:
+            run(target_dir, ext, tag_format, encoder_args)
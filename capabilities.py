@@ -0,0 +1,134 @@
+"""
+One-off probe of the external tools the pipeline depends on: fpcalc for the
+AcoustID fallback and ffmpeg with its audio encoders for transcoded profiles.
+The result is cached for the life of the process, so starting a job no longer
+spawns subprocesses; `reprobe()` (and the web UI's re-probe endpoint) refreshes
+it after a tool is installed or upgraded.
+"""
+import os
+import subprocess
+import threading
+import time
+
+import config
+from transcoder import get_profile, needs_transcode, plan_fanout
+from utils import log
+
+PROBE_TIMEOUT = 5  # seconds per probed command
+
+def _run(cmd):
+    """Runs a probe command; returns its stdout, or None if it couldn't be run."""
+    try:
+        result = subprocess.run(cmd, capture_output=True, check=True, text=True, timeout=PROBE_TIMEOUT)
+        return result.stdout
+    except (subprocess.CalledProcessError, FileNotFoundError, subprocess.TimeoutExpired, OSError) as e:
+        log(f"Capability probe '{' '.join(cmd)}' failed: {e}")
+        return None
+
+def probe_fpcalc():
+    if not os.path.exists(config.FPCALC_EXECUTABLE_PATH):
+        log(f"WARNING: fpcalc not found at '{config.FPCALC_EXECUTABLE_PATH}'. AcoustID fallback for MusicBrainz tagging will be skipped.")
+        return {"available": False, "version": None}
+    output = _run([config.FPCALC_EXECUTABLE_PATH, "-version"])
+    if output is None:
+        log(f"WARNING: fpcalc found at '{config.FPCALC_EXECUTABLE_PATH}' but could not be executed. "
+            "AcoustID fallback for MusicBrainz tagging will be skipped.")
+        return {"available": False, "version": None}
+    log(f"fpcalc executable found and is runnable at: '{config.FPCALC_EXECUTABLE_PATH}'.")
+    return {"available": True, "version": output.strip()}
+
+def parse_encoders(output):
+    """Audio encoder names from `ffmpeg -encoders` (lines like ' A....D libopus  ...')."""
+    encoders = []
+    in_list = False
+    for line in output.splitlines():
+        if line.strip().startswith("------"):
+            in_list = True
+            continue
+        parts = line.split()
+        if in_list and len(parts) >= 2 and parts[0].startswith("A"):
+            encoders.append(parts[1])
+    return sorted(encoders)
+
+def probe_ffmpeg():
+    version = _run(["ffmpeg", "-hide_banner", "-version"])
+    if version is None:
+        log("WARNING: ffmpeg not found. Transcoded output profiles will be unavailable.")
+        return {"available": False, "version": None, "encoders": []}
+    encoders = _run(["ffmpeg", "-hide_banner", "-encoders"]) or ""
+    return {"available": True, "version": version.splitlines()[0] if version else None, "encoders": parse_encoders(encoders)}
+
+def profile_status(profile, ffmpeg):
+    """Returns (available, reason) for one output profile given the ffmpeg probe."""
+    if not needs_transcode(profile):
+        return True, None
+    if not ffmpeg["available"]:
+        return False, "ffmpeg not installed"
+    if profile["codec"] not in ffmpeg["encoders"]:
+        return False, f"ffmpeg has no '{profile['codec']}' encoder"
+    return True, None
+
+def probe():
+    started = time.perf_counter()
+    ffmpeg = probe_ffmpeg()
+    profiles = {}
+    for name, profile in config.TRANSCODE_MAP.items():
+        available, reason = profile_status(profile, ffmpeg)
+        profiles[name] = {"available": available, "reason": reason}
+    result = {
+        "fpcalc": probe_fpcalc(),
+        "ffmpeg": ffmpeg,
+        "acoustid_key": bool(config.ACOUSTID_API_KEY) and config.ACOUSTID_API_KEY != "YOUR_ACOUSTID_API_KEY_HERE",
+        "profiles": profiles,
+        "probed_at": time.time(),
+    }
+    log(f"Capability probe finished in {time.perf_counter() - started:.2f}s: "
+        f"{sum(p['available'] for p in profiles.values())}/{len(profiles)} output profiles available")
+    return result
+
+_capabilities = None
+_capabilities_lock = threading.Lock()
+
+def get_capabilities():
+    """Returns the cached probe result, probing on first use."""
+    global _capabilities
+    with _capabilities_lock:
+        if _capabilities is None:
+            _capabilities = probe()
+        return _capabilities
+
+def reprobe():
+    global _capabilities
+    result = probe()
+    with _capabilities_lock:
+        _capabilities = result
+    return result
+
+def fpcalc_ready():
+    return get_capabilities()["fpcalc"]["available"]
+
+def acoustid_ready():
+    return get_capabilities()["acoustid_key"]
+
+def unavailable_formats(profile_names):
+    """
+    Maps each requested profile that can't be produced here to the reason.
+    Covers fan-out jobs too, where a download-as-is profile such as MP3 is
+    encoded from the shared FLAC source.
+    """
+    capabilities = get_capabilities()
+    names = [name.upper() for name in profile_names]
+    problems = {}
+    if len(names) > 1:
+        _, _, plan = plan_fanout(names)
+        for name, encoding in plan.items():
+            if encoding:
+                available, reason = profile_status(encoding, capabilities["ffmpeg"])
+                if not available:
+                    problems[name] = reason
+    else:
+        for name in names:
+            available, reason = profile_status(get_profile(name), capabilities["ffmpeg"])
+            if not available:
+                problems[name] = reason
+    return problems
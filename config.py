@@ -2,13 +2,12 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-# Qobuz API Configuration
-BASE_URL = "https://eu.qobuz.squid.wtf"
+# Qobuz API Configuration (squid.wtf mirrors, comma-separated)
 QOBUZ_API_BASE_URLS = [
-    "https://eu.qobuz.squid.wtf",
-    "https://us.qobuz.squid.wtf"
+    url.strip().rstrip("/") for url in
+    os.getenv("QOBUZ_API_BASE_URLS", "https://eu.qobuz.squid.wtf,https://us.qobuz.squid.wtf").split(",")
+    if url.strip()
 ]
-CURRENT_QOBUZ_API_INDEX = 0
 
 API_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36",
@@ -22,14 +21,56 @@ QOBUZ_CDN_DOWNLOAD_HEADERS = {
     "Referer": "https://play.qobuz.com/"
 }
 
+# Qobuz API client (search, album details, CDN URL resolution)
+QOBUZ_API_TIMEOUT = float(os.getenv("QOBUZ_API_TIMEOUT", "10"))  # seconds per request and mirror
+QOBUZ_API_CONNECTIONS = int(os.getenv("QOBUZ_API_CONNECTIONS", "16"))
+# Mirror health: rolling window per mirror, circuit breaker and optional hedging
+MIRROR_WINDOW = int(os.getenv("MIRROR_WINDOW", "50"))  # recent requests kept per mirror
+MIRROR_FAILURE_THRESHOLD = int(os.getenv("MIRROR_FAILURE_THRESHOLD", "3"))  # consecutive failures before a mirror is paused
+MIRROR_COOLDOWN = float(os.getenv("MIRROR_COOLDOWN", "60"))  # seconds a paused mirror is skipped
+MIRROR_SAMPLE_MAX_AGE = float(os.getenv("MIRROR_SAMPLE_MAX_AGE", "300"))  # seconds a request keeps counting towards a mirror's score
+# Hedge a request to the next mirror once it runs past this latency percentile of the primary (0 = off)
+MIRROR_HEDGE_PERCENTILE = int(os.getenv("MIRROR_HEDGE_PERCENTILE", "0"))
+MIRROR_HEDGE_MIN_SAMPLES = int(os.getenv("MIRROR_HEDGE_MIN_SAMPLES", "10"))
+
 # Download Directory
 DOWNLOAD_BASE_DIR = os.getenv("DOWNLOAD_BASE_DIR", "downloads")
 
-# Quality Map
-QUALITY_MAP = {
-    "FLAC": 27,
-    "MP3": 5,
-}
+# Download Concurrency / Connection Pooling
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "4"))
+DOWNLOAD_CONNECTIONS_PER_HOST = int(os.getenv("DOWNLOAD_CONNECTIONS_PER_HOST", "8"))
+DOWNLOAD_DNS_CACHE_TTL = int(os.getenv("DOWNLOAD_DNS_CACHE_TTL", "300"))
+DOWNLOAD_KEEPALIVE_TIMEOUT = int(os.getenv("DOWNLOAD_KEEPALIVE_TIMEOUT", "30"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "4"))
+DOWNLOAD_BACKOFF_BASE = float(os.getenv("DOWNLOAD_BACKOFF_BASE", "1.0"))  # seconds, doubled per retry
+# Incremental sync: skip tracks already on disk and intact, re-tag untagged ones
+SKIP_EXISTING = os.getenv("SKIP_EXISTING", "true").lower() in ("1", "true", "yes")
+RETAG_EXISTING = os.getenv("RETAG_EXISTING", "false").lower() in ("1", "true", "yes")
+SYNC_MIN_FILE_BYTES = int(os.getenv("SYNC_MIN_FILE_BYTES", "16384"))
+SYNC_DURATION_TOLERANCE = float(os.getenv("SYNC_DURATION_TOLERANCE", "2.0"))  # seconds
+# MP3/M4A smaller than this share of bitrate x duration are treated as truncated downloads
+SYNC_MIN_SIZE_RATIO = float(os.getenv("SYNC_MIN_SIZE_RATIO", "0.95"))
+RESOLVE_CONCURRENCY = int(os.getenv("RESOLVE_CONCURRENCY", "8"))
+RESOLVE_TIMEOUT = int(os.getenv("RESOLVE_TIMEOUT", "15"))
+
+# Transcoding (ffmpeg processes running at once, shared by all jobs)
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(os.cpu_count() or 2)))
+# Pipe the download straight into ffmpeg instead of writing the FLAC to disk first
+STREAM_TRANSCODE = os.getenv("STREAM_TRANSCODE", "false").lower() in ("1", "true", "yes")
+
+# Library index of downloaded tracks
+LIBRARY_INDEX_ENABLED = os.getenv("LIBRARY_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+LIBRARY_DB_PATH = os.getenv("LIBRARY_DB_PATH", os.path.join("cache", "library.sqlite3"))
+LIBRARY_SCAN_WORKERS = int(os.getenv("LIBRARY_SCAN_WORKERS", str(os.cpu_count() or 2)))
+
+# Background download jobs (web UI)
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", os.path.join("cache", "jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_DOWNLOAD_CONCURRENCY = int(os.getenv("JOB_DOWNLOAD_CONCURRENCY", str(DOWNLOAD_CONCURRENCY)))
+
+# Download -> Tag Pipeline
+TAG_WORKERS = int(os.getenv("TAG_WORKERS", "2"))
+TAG_QUEUE_SIZE = int(os.getenv("TAG_QUEUE_SIZE", "4"))
 
 # MusicBrainz Configuration
 MUSICBRAINZ_USER_AGENT = os.getenv(
@@ -37,25 +78,74 @@ MUSICBRAINZ_USER_AGENT = os.getenv(
     "QobuzSquidDownloader/1.0 ( your.email@example.com )"
 )
 
+# Shared rate limits: service -> (requests per second, burst)
+RATE_LIMITS = {
+    "musicbrainz": (1.0, 1),  # MusicBrainz allows 1 req/s on average, no bursts
+    "coverart": (5.0, 5),
+    "acoustid": (3.0, 3),
+}
+RATE_LIMITED_HOSTS = {
+    "musicbrainz.org": "musicbrainz",
+    "coverartarchive.org": "coverart",
+    "acoustid.org": "acoustid",
+}
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BACKOFF = 2.0  # seconds, when a 503 carries no Retry-After
+
 # AcoustID Configuration
 ACOUSTID_API_KEY = os.getenv("ACOUSTID_API_KEY", "YOUR_ACOUSTID_API_KEY_HERE")
 FPCALC_EXECUTABLE_PATH = "/usr/local/bin/fpcalc"
+# Fingerprints are cached (keyed by audio MD5 / file identity) and computed in a process pool
+FINGERPRINT_DB_PATH = os.getenv("FINGERPRINT_DB_PATH", os.path.join("cache", "fingerprints.sqlite3"))
+FINGERPRINT_WORKERS = int(os.getenv("FINGERPRINT_WORKERS", str(os.cpu_count() or 2)))
+# Lookups from concurrent tag workers are sent as one request of up to this many fingerprints
+ACOUSTID_BATCH_SIZE = int(os.getenv("ACOUSTID_BATCH_SIZE", "10"))
+ACOUSTID_BATCH_WINDOW = float(os.getenv("ACOUSTID_BATCH_WINDOW", "0.5"))  # seconds a lookup waits for company
 
 # Runtime caches
 SESSION_COOKIES = {}
 _album_release_cache = {}
 
-# Format mapping
+# Persistent API response cache (MusicBrainz, Cover Art Archive, Qobuz)
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_OFFLINE = os.getenv("CACHE_OFFLINE", "false").lower() == "true"
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", os.path.join("cache", "responses.sqlite3"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "256")) * 1024 * 1024
+CACHE_TTLS = {
+    "default": 24 * 3600,
+    "musicbrainz": 7 * 24 * 3600,
+    "coverart": 30 * 24 * 3600,
+    "acoustid": 30 * 24 * 3600,
+    "qobuz_search": 3600,
+    "qobuz_album": 24 * 3600,
+}
+
+# Web UI search results, kept server-side (the session cookie only holds an id)
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "900"))  # seconds
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "128"))
+# Qobuz album details shared by album selection, release matching and tagging
+ALBUM_CACHE_TTL = int(os.getenv("ALBUM_CACHE_TTL", "3600"))  # seconds
+ALBUM_CACHE_MAX_ENTRIES = int(os.getenv("ALBUM_CACHE_MAX_ENTRIES", "64"))
+
+# Output profiles. "download"/"quality" pick the stream fetched from Qobuz
+# (27 = hi-res FLAC, 6 = 16/44.1 FLAC, 5 = MP3 320), "ext" the output file and
+# "tags" the tag writer (vorbis / id3 / mp4). Profiles with a "codec" are
+# transcoded by ffmpeg using that encoder and the extra "args"; "encode" is how
+# a download-as-is profile is made from FLAC when a multi-format job shares one source.
 TRANSCODE_MAP = {
-    "FLAC": {"download": "FLAC", "ext": "flac"},
-    "MP3":  {"download": "MP3",  "ext": "mp3"},
-    "ALAC": {"download": "FLAC", "ext": "m4a"},
+    "FLAC":    {"download": "FLAC", "quality": 27, "ext": "flac", "tags": "vorbis"},
+    "MP3":     {"download": "MP3",  "quality": 5,  "ext": "mp3",  "tags": "id3",
+                "encode": {"codec": "libmp3lame", "args": ["-b:a", "320k"]}},
+    "ALAC":    {"download": "FLAC", "quality": 27, "ext": "m4a",  "tags": "mp4", "codec": "alac"},
+    "FLAC_16": {"download": "FLAC", "quality": 6,  "ext": "flac", "tags": "vorbis",
+                "encode": {"codec": "flac", "args": ["-af", "aresample=osr=44100:osf=s16:dither_method=triangular", "-sample_fmt", "s16"]}},
+    "MP3_V0":  {"download": "FLAC", "quality": 6,  "ext": "mp3",  "tags": "id3", "codec": "libmp3lame", "args": ["-q:a", "0"]},
+    "AAC":     {"download": "FLAC", "quality": 6,  "ext": "m4a",  "tags": "mp4", "codec": "aac", "args": ["-b:a", "256k"]},
+    "OPUS":    {"download": "FLAC", "quality": 6,  "ext": "opus", "tags": "vorbis", "codec": "libopus", "args": ["-b:a", "128k", "-vbr", "on"]},
 }
 
+# Profiles the web UI downloads by default (comma-separated; several = one download fanned out)
+DEFAULT_FORMATS = [name.strip().upper() for name in os.getenv("DEFAULT_FORMATS", "FLAC").split(",") if name.strip()]
+
 # Logging
 LOGGING_ENABLED = os.getenv("LOGGING_ENABLED", "false").lower() == "true"
-
-def switch_qobuz_api_url():
-    global CURRENT_QOBUZ_API_INDEX, BASE_URL
-    CURRENT_QOBUZ_API_INDEX = (CURRENT_QOBUZ_API_INDEX + 1) % len(QOBUZ_API_BASE_URLS)
-    BASE_URL = QOBUZ_API_BASE_URLS[CURRENT_QOBUZ_API_INDEX]
\ No newline at end of file
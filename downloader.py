@@ -1,139 +1,514 @@
 import os
+import contextlib
+import json
+import shutil
+import time
 import asyncio
 import aiohttp
 from tqdm.asyncio import tqdm
 
-from qobuz_api import get_qobuz_cdn_url
+from qobuz_api import get_qobuz_cdn_url_async
 from utils import clean_filename, log
 import config # Import config for DOWNLOAD_BASE_DIR, QOBUZ_CDN_DOWNLOAD_HEADERS
-from config import TRANSCODE_MAP
-from transcoder import transcode
+from transcoder import transcode_async, transcode_stream_async, get_profile, needs_transcode, plan_fanout
+from progress import STAGE_RESOLVING, STAGE_TRANSCODING, STAGE_FAILED, STAGE_DONE, TrackGroup, progress_key
+from library_index import get_library
+from sync import check_existing_file, SYNC_MISSING, SYNC_CORRUPT, SYNC_UNTAGGED
 import functools
 
-async def download_music_async(qobuz_cdn_url, output_filename, requested_format="FLAC", target_directory=config.DOWNLOAD_BASE_DIR, overall_pbar=None, file_ready_queue=None, download_format=None):
+def create_download_session():
+    """
+    Creates a connection-pooled aiohttp session for CDN downloads.
+    One session is meant to be shared by every track of a job so connections
+    (and TLS handshakes) to the CDN host are reused via keep-alive.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=max(config.DOWNLOAD_CONCURRENCY, config.DOWNLOAD_CONNECTIONS_PER_HOST),
+        limit_per_host=config.DOWNLOAD_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=config.DOWNLOAD_DNS_CACHE_TTL,
+        keepalive_timeout=config.DOWNLOAD_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, headers=config.QOBUZ_CDN_DOWNLOAD_HEADERS)
+
+# Staging folder (inside the album folder) for sources of multi-profile jobs
+FANOUT_SOURCE_DIR = ".source"
+
+# Statuses from the CDN that mean the signed URL has expired and must be re-resolved
+URL_EXPIRED_STATUSES = (401, 403, 404, 410)
+
+class IncompleteDownloadError(Exception):
+    """The body ended before the advertised length was received."""
+
+def _read_sidecar(sidecar_path):
+    try:
+        with open(sidecar_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_sidecar(sidecar_path, meta):
+    with open(sidecar_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+def _discard_partial(temp_path, sidecar_path):
+    for path in (temp_path, sidecar_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+def _parse_content_range(value):
+    """'bytes 100-199/1000' -> (100, 1000); total is None when the server sends '*'."""
+    try:
+        unit_range, total = value.split("/")
+        start = int(unit_range.split()[1].split("-")[0])
+        return start, (int(total) if total != "*" else None)
+    except (AttributeError, IndexError, ValueError):
+        return None, None
+
+async def _fetch_to_partial(session, url, temp_path, sidecar_path, headers, overall_pbar):
+    """
+    One download attempt into temp_path, resuming from its current size with a
+    Range request when a sidecar from an earlier attempt is present.
+    """
+    meta = _read_sidecar(sidecar_path) if os.path.exists(temp_path) else None
+    offset = os.path.getsize(temp_path) if meta else 0
+    if meta and meta.get("expected_length") and offset == meta["expected_length"]:
+        return
+
+    request_headers = dict(headers)
+    if offset:
+        request_headers["Range"] = f"bytes={offset}-"
+        # Fall back to a full 200 response if the file changed since the partial was written
+        validator = meta.get("etag") or meta.get("last_modified")
+        if validator:
+            request_headers["If-Range"] = validator
+
+    async with session.get(url, headers=request_headers) as response:
+        if response.status == 416:
+            _discard_partial(temp_path, sidecar_path)
+            raise IncompleteDownloadError("server rejected the resume range; restarting")
+        response.raise_for_status()
+
+        if response.status == 206:
+            start, expected_length = _parse_content_range(response.headers.get("Content-Range"))
+            if start != offset:
+                _discard_partial(temp_path, sidecar_path)
+                raise IncompleteDownloadError(f"server resumed at byte {start}, expected {offset}")
+            mode = "ab"
+            log(f"Resuming '{os.path.basename(temp_path)}' from byte {offset}")
+        else:
+            offset = 0
+            expected_length = int(response.headers.get("content-length", 0)) or None
+            mode = "wb"
+
+        _write_sidecar(sidecar_path, {
+            "url": url,
+            "etag": response.headers.get("ETag") or (meta or {}).get("etag"),
+            "last_modified": response.headers.get("Last-Modified") or (meta or {}).get("last_modified"),
+            "expected_length": expected_length,
+        })
+        if overall_pbar:
+            overall_pbar.reset(total=expected_length or 0)
+            if offset:
+                overall_pbar.update(offset)
+
+        with open(temp_path, mode) as f:
+            async for chunk in response.content.iter_chunked(65536):
+                f.write(chunk)
+                if overall_pbar:
+                    overall_pbar.update(len(chunk))
+
+    received = os.path.getsize(temp_path)
+    if expected_length and received != expected_length:
+        raise IncompleteDownloadError(f"received {received} of {expected_length} bytes")
+
+async def _stream_to_transcoder(session, url, output_path, profile, headers, overall_pbar):
+    """
+    Pipes the CDN response straight into ffmpeg so the source never touches disk.
+    Returns ffmpeg's success; network errors and short bodies raise.
+    """
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        expected_length = int(response.headers.get("content-length", 0)) or None
+        if overall_pbar:
+            overall_pbar.reset(total=expected_length or 0)
+        received = 0
+
+        async def body():
+            nonlocal received
+            async for chunk in response.content.iter_chunked(65536):
+                received += len(chunk)
+                if overall_pbar:
+                    overall_pbar.update(len(chunk))
+                yield chunk
+            # ffmpeg is still flushing the tail of the encode
+            if overall_pbar:
+                overall_pbar.set_description(STAGE_TRANSCODING)
+
+        success = await transcode_stream_async(body(), output_path, profile)
+
+    if expected_length and received != expected_length:
+        raise IncompleteDownloadError(f"received {received} of {expected_length} bytes")
+    return success
+
+@contextlib.asynccontextmanager
+async def _no_limit():
+    yield
+
+async def download_music_async(qobuz_cdn_url, output_filename, requested_format="FLAC", target_directory=config.DOWNLOAD_BASE_DIR, overall_pbar=None, file_ready_queue=None, download_format=None, session=None, resolve_url=None, stream_transcode=None, download_slot=None):
     """
     Downloads the music file directly from the Qobuz CDN URL asynchronously.
     Includes progress bar using tqdm.
+    If no shared session is given, a one-off session is opened for this file.
+    Interrupted transfers are retried with exponential backoff and resumed from
+    the partial <name>.tmp file; `resolve_url` is an optional coroutine function
+    used to fetch a fresh signed URL when the current one has expired.
+    With stream_transcode (default config.STREAM_TRANSCODE), outputs that need
+    transcoding are first attempted by piping the response into ffmpeg; if that
+    fails the track falls back to the resumable download-then-transcode path.
+    download_slot (e.g. the job's download semaphore) is held only while bytes
+    are coming off the network, not during retry backoff or a file-based
+    encode, so slow encodes don't hold up other downloads.
     """
+    def slot():
+        return download_slot if download_slot is not None else _no_limit()
+
     if not qobuz_cdn_url:
         return None
 
     download_headers = config.QOBUZ_CDN_DOWNLOAD_HEADERS.copy()
-    format_info = TRANSCODE_MAP.get(requested_format.upper(), TRANSCODE_MAP["FLAC"])
-    download_format = format_info["download"]
-    output_ext = format_info["ext"]
+    profile = get_profile(requested_format)
+    profile_name = requested_format.upper() if requested_format.upper() in config.TRANSCODE_MAP else "FLAC"
+    output_ext = profile["ext"]
 
-    if requested_format.lower() in ("flac", "hi-res"):
+    # Accept what is fetched from the CDN, not what it is transcoded into
+    if profile["download"] == "FLAC":
         download_headers["Accept"] = "audio/flac, */*"
-    elif requested_format.lower().startswith("mp3"):
+    elif profile["download"] == "MP3":
         download_headers["Accept"] = "audio/mpeg, */*"
-    elif requested_format.lower() == "alac":
-        download_headers["Accept"] = "audio/x-m4a, */*"
     else:
         download_headers["Accept"] = "*/*"
 
     os.makedirs(target_directory, exist_ok=True)
     temp_path = os.path.join(target_directory, output_filename + ".tmp")
+    sidecar_path = temp_path + ".json"
     final_path = os.path.splitext(os.path.join(target_directory, output_filename))[0] + f".{output_ext}"
 
+    owns_session = session is None
+    if owns_session:
+        session = aiohttp.ClientSession(headers=download_headers)
+
     try:
-        async with aiohttp.ClientSession(headers=download_headers) as session:
-            async with session.get(qobuz_cdn_url) as response:
-                response.raise_for_status()
-                total_size = int(response.headers.get('content-length', 0))
-                with open(temp_path, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(8192):
-                        f.write(chunk)
-                        if overall_pbar:
-                            overall_pbar.update(len(chunk))
+        if (config.STREAM_TRANSCODE if stream_transcode is None else stream_transcode) and needs_transcode(profile):
+            # ffmpeg picks the muxer from the extension, so keep it on the in-progress name
+            partial_path = os.path.splitext(final_path)[0] + ".part." + output_ext
+            try:
+                # Streaming encodes while downloading, so the slot covers both
+                async with slot():
+                    streamed = await _stream_to_transcoder(session, qobuz_cdn_url, partial_path, profile, download_headers, overall_pbar)
+                if streamed:
+                    os.replace(partial_path, final_path)
+                    if file_ready_queue:
+                        await file_ready_queue.put((final_path, profile_name))
+                    return final_path
+                tqdm.write(f"Stream transcode of '{output_filename}' failed; falling back to download-then-transcode.")
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownloadError) as e:
+                tqdm.write(f"Stream transcode of '{output_filename}' interrupted ({e}); falling back to a resumable download.")
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+        last_error = None
+        for attempt in range(config.DOWNLOAD_RETRIES + 1):
+            try:
+                async with slot():
+                    await _fetch_to_partial(session, qobuz_cdn_url, temp_path, sidecar_path, download_headers, overall_pbar)
+                break
+            except aiohttp.ClientResponseError as e:
+                last_error = e
+                if e.status in URL_EXPIRED_STATUSES and resolve_url:
+                    log(f"CDN URL for '{output_filename}' rejected with HTTP {e.status}; re-resolving.")
+                    qobuz_cdn_url = await resolve_url() or qobuz_cdn_url
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownloadError) as e:
+                last_error = e
+            if attempt < config.DOWNLOAD_RETRIES:
+                delay = config.DOWNLOAD_BACKOFF_BASE * (2 ** attempt)
+                tqdm.write(f"Download of '{output_filename}' interrupted ({last_error}); retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+        else:
+            tqdm.write(f"Error during download of '{output_filename}': {last_error}. Partial data kept for resume.")
+            return None
+
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
         # After download, handle transcoding or renaming
-        if download_format.lower() == output_ext:
+        if not needs_transcode(profile):
             # No transcoding needed, just rename
             os.rename(temp_path, final_path)
             if file_ready_queue:
-                await file_ready_queue.put((final_path, download_format))
+                await file_ready_queue.put((final_path, profile_name))
             return final_path
         else:
             # Transcoding needed
-            success = transcode(temp_path, final_path)
+            if overall_pbar:
+                overall_pbar.set_description(STAGE_TRANSCODING)
+            success = await transcode_async(temp_path, final_path, profile)
             if success:
                 os.remove(temp_path)
                 if file_ready_queue:
-                    await file_ready_queue.put((final_path, download_format))
+                    await file_ready_queue.put((final_path, profile_name))
                 return final_path
             else:
                 tqdm.write(f"Transcoding failed for {temp_path}")
+                if os.path.exists(final_path):
+                    os.remove(final_path)
                 return None
-    except aiohttp.ClientError as e:
-        tqdm.write(f"Error during download of '{output_filename}': {e}")
-        return None
     except Exception as e:
         tqdm.write(f"An unexpected error occurred during download of '{output_filename}': {e}")
         return None
+    finally:
+        if owns_session:
+            await session.close()
+
+def build_output_filename(track_item, download_format):
+    clean_title = clean_filename(track_item['title'])
+    clean_artist = clean_filename(track_item['artist'])
+    # You still need the format for file extension
+    ext = get_profile(download_format)["ext"]
+    return f"{clean_artist} - {clean_title}.{ext}"
+
+def final_output_path(track_item, download_format, target_directory):
+    """Path download_music_async will write the finished track to."""
+    return os.path.join(target_directory, build_output_filename(track_item, download_format))
+
+def track_album_id(track_item, qobuz_album_id=None):
+    """The Qobuz album a track belongs to: the job's album, else the one in the track's own payload."""
+    return qobuz_album_id or (track_item.get('raw_data', {}).get('album') or {}).get('id')
+
+async def sync_existing_tracks(tracks, download_format, current_download_dir, file_ready_queue=None, retag_existing=False, job_progress=None, qobuz_album_id=None):
+    """
+    Checks the files already in current_download_dir before any network request.
+    Intact, untagged files (or every intact file with retag_existing) are queued
+    straight for tagging; returns the tracks that are missing or corrupt and
+    still need downloading, plus the paths of the ones that don't.
+    """
+    loop = asyncio.get_running_loop()
+    paths = [final_output_path(track_item, download_format, current_download_dir) for track_item in tracks]
+    states = await asyncio.gather(*(
+        loop.run_in_executor(None, check_existing_file, path, track_item)
+        for path, track_item in zip(paths, tracks)
+    ))
+
+    to_download, present = [], []
+    library = get_library()
+    for track_item, path, state in zip(tracks, paths, states):
+        if state in (SYNC_MISSING, SYNC_CORRUPT):
+            if state == SYNC_CORRUPT:
+                log(f"Existing file '{os.path.basename(path)}' is incomplete or invalid; downloading it again.")
+            to_download.append(track_item)
+            continue
+        present.append(path)
+        if library:
+            library.record(path, qobuz_track_id=track_item['id'], qobuz_album_id=track_album_id(track_item, qobuz_album_id),
+                           title=track_item['title'], artist=track_item['artist'])
+        key = progress_key(path, download_format)
+        if job_progress:
+            job_progress.track(key, f"{track_item['artist']} - {track_item['title']}")
+        if file_ready_queue and (state == SYNC_UNTAGGED or retag_existing):
+            await file_ready_queue.put((path, download_format.upper()))
+        elif job_progress:
+            job_progress.set_stage(key, STAGE_DONE)
+
+    log(f"Incremental sync: {len(present)} track(s) already on disk, {len(to_download)} to download.")
+    return to_download, present
 
-async def fetch_file_size(session, url):
+def discard_partial(path):
     try:
-        async with session.head(url) as resp:
-            return int(resp.headers.get('content-length', 0))
-    except Exception:
-        return 0
+        if os.path.exists(path):
+            os.remove(path)
+    except OSError as e:
+        log(f"Could not remove partial file '{path}': {e}")
+
+async def fan_out_track(source_path, track_item, plan, output_dirs, file_ready_queue=None, job_progress=None):
+    """
+    Produces several output profiles of one track from its single downloaded
+    source: encodes run in parallel through the transcode pool, one profile that
+    needs the source as-is gets it moved into place, and each finished output is
+    queued for tagging. A profile that can't be written (encoder failure, disk
+    full, permissions) is cleaned up and marked failed without affecting the
+    others. Returns the paths produced.
+    """
+    loop = asyncio.get_running_loop()
+    copies = [name for name, encoding in plan.items() if encoding is None]
+    move_target = copies.pop() if copies else None
+
+    async def produce(name):
+        output_path = final_output_path(track_item, name, output_dirs[name])
+        try:
+            os.makedirs(output_dirs[name], exist_ok=True)
+            if name == move_target:
+                os.replace(source_path, output_path)
+                return output_path
+            if plan[name] is None:
+                await loop.run_in_executor(None, shutil.copyfile, source_path, output_path)
+                return output_path
+            if await transcode_async(source_path, output_path, plan[name]):
+                return output_path
+            tqdm.write(f"Transcoding '{os.path.basename(output_path)}' to {name} failed.")
+        except OSError as e:
+            tqdm.write(f"Writing '{os.path.basename(output_path)}' for {name} failed: {e}")
+        discard_partial(output_path)
+        if job_progress:
+            job_progress.set_stage(progress_key(output_path, name), STAGE_FAILED)
+        return None
 
-async def main_download_orchestrator(items_to_download, download_format, current_download_dir, file_ready_queue=None):
-    download_tasks = []
-    file_infos = []
-    urls_and_filenames = []
+    names = [name for name in plan if name != move_target]
+    outputs = await asyncio.gather(*(produce(name) for name in names))
+    # The source is only moved once every other profile has read it
+    if move_target:
+        names.append(move_target)
+        outputs.append(await produce(move_target))
+    discard_partial(source_path)
 
-    quality = config.QUALITY_MAP.get(download_format.upper(), 27)
+    produced = []
+    for name, output_path in zip(names, outputs):
+        if output_path:
+            produced.append(output_path)
+            if file_ready_queue:
+                await file_ready_queue.put((output_path, name))
+    return produced
 
-    for track_num, track_item in enumerate(items_to_download, 1):
+async def main_download_orchestrator(items_to_download, download_format, current_download_dir, file_ready_queue=None, max_concurrency=None, job_progress=None, skip_existing=None, retag_existing=None, qobuz_album_id=None):
+    """
+    Resolves CDN URLs concurrently and starts each track's download as soon as
+    its own URL is known, instead of resolving the whole album up front.
+    With skip_existing (default config.SKIP_EXISTING), tracks already on disk
+    are checked locally first and only missing or corrupt ones are fetched.
+    download_format may be a list of profiles: each track is then downloaded
+    once and fanned out into one subfolder per profile. qobuz_album_id is
+    recorded in the library index so album ownership can be shown in search.
+    """
+    formats = [download_format] if isinstance(download_format, str) else list(download_format)
+    unknown = [name for name in formats if str(name).upper() not in config.TRANSCODE_MAP]
+    if unknown:
+        print(f"Unknown output format(s): {', '.join(map(str, unknown))}. Choose from {', '.join(config.TRANSCODE_MAP)}.")
+        return False
+    fan_out = len(formats) > 1
+    if fan_out:
+        source_format, quality, plan = plan_fanout(formats)
+        formats = list(plan)
+        output_dirs = {name: os.path.join(current_download_dir, name) for name in formats}
+        source_dir = os.path.join(current_download_dir, FANOUT_SOURCE_DIR)
+        log(f"Fanning out to {', '.join(formats)} from one {source_format} download per track.")
+    else:
+        quality = get_profile(formats[0])["quality"]
+        output_dirs = {formats[0]: current_download_dir}
+    tracks = []
+    for track_item in items_to_download:
         if not track_item.get("id"):
             log(f"Skipping '{track_item.get('title', 'Unknown Track')}' as it has no ID.")
             continue
-        log(f"Preparing download task for: {track_item['artist']} - {track_item['title']}")
-        qobuz_cdn_url = get_qobuz_cdn_url(track_item['id'], quality)
-        if qobuz_cdn_url:
-            clean_title = clean_filename(track_item['title'])
-            clean_artist = clean_filename(track_item['artist'])
-            # You still need the format for file extension
-            ext = download_format.lower() if download_format.upper() != "ALAC" else "m4a"
-            output_filename = f"{clean_artist} - {clean_title}.{ext}"
-            urls_and_filenames.append((qobuz_cdn_url, output_filename))
-        else:
-            log(f"Failed to get Qobuz CDN URL for '{track_item['title']}'. This track will not be downloaded.")
+        tracks.append(track_item)
 
-    if not urls_and_filenames:
+    if not tracks:
         print("No valid download tasks were created.")
         return False
 
-    # Batch HEAD requests for file sizes (no progress bar)
-    async with aiohttp.ClientSession() as session:
-        size_tasks = [fetch_file_size(session, url) for url, _ in urls_and_filenames]
-        sizes = await asyncio.gather(*size_tasks)
-
-    total_bytes = sum(sizes)
-    file_infos = [(url, filename, size) for (url, filename), size in zip(urls_and_filenames, sizes)]
-
-    log(f"\n--- Starting {len(file_infos)} concurrent downloads ---")
-    # REMOVE this overall progress bar too:
-    # with tqdm(total=total_bytes, unit='B', unit_scale=True, desc="Total Progress") as overall_pbar:
-    #     for qobuz_cdn_url, output_filename, _ in file_infos:
-    #         task = download_music_async(...)
-    #         download_tasks.append(task)
-    #     await asyncio.gather(*download_tasks)
-    # log("\nAll concurrent downloads completed.")
-    # return True
-
-    # INSTEAD, just run the downloads without a progress bar:
-    for qobuz_cdn_url, output_filename, _ in file_infos:
-        task = download_music_async(
+    present = []
+    # Profiles still to be produced per track
+    wanted = {track_item['id']: list(formats) for track_item in tracks}
+    if config.SKIP_EXISTING if skip_existing is None else skip_existing:
+        for name in formats:
+            missing, found = await sync_existing_tracks(
+                tracks, name, output_dirs[name],
+                file_ready_queue=file_ready_queue,
+                retag_existing=config.RETAG_EXISTING if retag_existing is None else retag_existing,
+                job_progress=job_progress,
+                qobuz_album_id=qobuz_album_id
+            )
+            present.extend(found)
+            missing_ids = {track_item['id'] for track_item in missing}
+            for track_item in tracks:
+                if track_item['id'] not in missing_ids:
+                    wanted[track_item['id']].remove(name)
+        tracks = [track_item for track_item in tracks if wanted[track_item['id']]]
+        if not tracks:
+            log("All requested tracks are already present; nothing to download.")
+            return True
+
+    concurrency = max_concurrency or config.DOWNLOAD_CONCURRENCY
+    resolve_semaphore = asyncio.Semaphore(config.RESOLVE_CONCURRENCY)
+    download_semaphore = asyncio.Semaphore(concurrency)
+    resolve_timings = []
+    library = get_library()
+
+    async def resolve_and_download(cdn_session, track_item):
+        output_filename = build_output_filename(track_item, source_format if fan_out else formats[0])
+        track_progress = None
+        if job_progress:
+            label = f"{track_item['artist']} - {track_item['title']}"
+            if fan_out:
+                # One row per output profile; the shared download advances them together
+                track_progress = TrackGroup([
+                    job_progress.track(progress_key(output_filename, name), f"{label} ({name})")
+                    for name in wanted[track_item['id']]
+                ])
+            else:
+                track_progress = job_progress.track(progress_key(output_filename, formats[0]), label)
+        async with resolve_semaphore:
+            if track_progress:
+                track_progress.set_description(STAGE_RESOLVING)
+            started = time.perf_counter()
+            qobuz_cdn_url = await get_qobuz_cdn_url_async(track_item['id'], quality)
+            elapsed = time.perf_counter() - started
+        resolve_timings.append(elapsed)
+        log(f"Resolved CDN URL for '{track_item['artist']} - {track_item['title']}' in {elapsed * 1000:.0f} ms")
+        if not qobuz_cdn_url:
+            log(f"Failed to get Qobuz CDN URL for '{track_item['title']}'. This track will not be downloaded.")
+            if track_progress:
+                track_progress.set_description(STAGE_FAILED)
+            return None
+
+        # The slot is taken inside for the transfer only; encodes queue on the transcode pool instead
+        final_path = await download_music_async(
             qobuz_cdn_url, output_filename,
-            requested_format=download_format,
-            target_directory=current_download_dir,
-            overall_pbar=None,
-            file_ready_queue=file_ready_queue,
-            download_format=download_format
+            requested_format=source_format if fan_out else formats[0],
+            target_directory=source_dir if fan_out else current_download_dir,
+            overall_pbar=track_progress,
+            # Fanned-out sources are tagged per output, not as downloaded
+            file_ready_queue=None if fan_out else file_ready_queue,
+            session=cdn_session,
+            resolve_url=lambda: get_qobuz_cdn_url_async(track_item['id'], quality),
+            stream_transcode=False if fan_out else None,
+            download_slot=download_semaphore
         )
-        download_tasks.append(task)
-    await asyncio.gather(*download_tasks)
+        output_paths = [final_path] if final_path else []
+        if fan_out and final_path:
+            if track_progress:
+                track_progress.set_description(STAGE_TRANSCODING)
+            targets = {name: plan[name] for name in wanted[track_item['id']]}
+            output_paths = await fan_out_track(final_path, track_item, targets, output_dirs, file_ready_queue, job_progress)
+        if not output_paths and track_progress:
+            track_progress.set_description(STAGE_FAILED)
+        if library:
+            for output_path in output_paths:
+                library.record(output_path, qobuz_track_id=track_item['id'], qobuz_album_id=track_album_id(track_item, qobuz_album_id),
+                               title=track_item['title'], artist=track_item['artist'])
+        return output_paths
+
+    log(f"\n--- Starting {len(tracks)} downloads ({concurrency} at a time) ---")
+    # URL resolution goes through the shared Qobuz API client; only CDN traffic uses this job's pool
+    async with create_download_session() as cdn_session:
+        results = await asyncio.gather(*(
+            resolve_and_download(cdn_session, track_item)
+            for track_item in tracks
+        ))
+
+    if fan_out and os.path.isdir(source_dir) and not os.listdir(source_dir):
+        os.rmdir(source_dir)
+
+    if resolve_timings:
+        log(f"CDN URL resolution: {len(resolve_timings)} tracks, "
+            f"avg {sum(resolve_timings) / len(resolve_timings) * 1000:.0f} ms, "
+            f"max {max(resolve_timings) * 1000:.0f} ms")
     log("\nAll concurrent downloads completed.")
-    return True
\ No newline at end of file
+    return any(results) or bool(present)
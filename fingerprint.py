@@ -0,0 +1,318 @@
+"""
+Chromaprint fingerprints for the AcoustID fallback of the tagger.
+Fingerprints are computed in a process pool and stored in a SQLite cache, so
+re-tagging a file doesn't run fpcalc over the same audio again. FLAC files are
+keyed by the MD5 of their decoded audio (STREAMINFO), which survives tag edits;
+other files by size + mtime + inode, carried over when the tagger rewrites them.
+Lookups from concurrent tag workers are batched into multi-fingerprint AcoustID
+requests and their results kept in the response cache.
+`python fingerprint.py [DIR]` warms the cache for a whole library before a retag.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import acoustid
+import requests
+import mutagen
+from mutagen.flac import FLAC
+
+import config
+from rate_limiter import limited_post
+from response_cache import get_cache, OfflineCacheMiss
+from sync import EXPECTED_CONTAINERS
+from utils import log
+
+ACOUSTID_LOOKUP_URL = "https://api.acoustid.org/v2/lookup"
+
+def fingerprint_key(path):
+    """Cache key for a file's audio, or None if the file can't be read."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if path.lower().endswith(".flac"):
+        try:
+            md5 = FLAC(path).info.md5_signature
+        except (mutagen.MutagenError, OSError):
+            md5 = 0
+        if md5:  # 0 when the encoder didn't compute one
+            return f"flac-md5:{md5:032x}"
+    return f"stat:{stat.st_size}:{stat.st_mtime_ns}:{stat.st_ino}"
+
+def compute_fingerprint(path):
+    """Runs Chromaprint on one file; runs in a worker process. Returns (duration, fingerprint)."""
+    if os.path.exists(config.FPCALC_EXECUTABLE_PATH):
+        os.environ.setdefault(acoustid.FPCALC_ENVVAR, config.FPCALC_EXECUTABLE_PATH)
+    duration, fingerprint = acoustid.fingerprint_file(path)
+    if isinstance(fingerprint, bytes):
+        fingerprint = fingerprint.decode("ascii")
+    return duration, fingerprint
+
+class FingerprintCache:
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.hits = 0
+        self.computed = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS fingerprints (
+                key TEXT PRIMARY KEY,
+                duration REAL NOT NULL,
+                fingerprint TEXT NOT NULL,
+                created REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT duration, fingerprint FROM fingerprints WHERE key = ?", (key,)).fetchone()
+        return tuple(row) if row else None
+
+    def set_many(self, rows):
+        """Stores (key, duration, fingerprint) rows."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fingerprints (key, duration, fingerprint, created) VALUES (?, ?, ?, ?)",
+                ((key, duration, fingerprint, now) for key, duration, fingerprint in rows)
+            )
+            self._conn.commit()
+
+    def carry_over(self, old_key, path):
+        """Re-files the fingerprint stored under old_key under the file's current key (after a tag write)."""
+        new_key = fingerprint_key(path)
+        if not old_key or not new_key or new_key == old_key:
+            return
+        cached = self.get(old_key)
+        if cached:
+            self.set_many([(new_key, *cached)])
+
+    def fingerprint_files(self, paths, workers=None):
+        """
+        Returns {path: (duration, fingerprint)} for the given files, computing
+        cache misses in parallel. Files fpcalc can't read are left out.
+        """
+        results, misses = {}, []
+        for path in paths:
+            key = fingerprint_key(path)
+            cached = self.get(key) if key else None
+            if cached:
+                results[path] = cached
+            elif key:
+                misses.append((path, key))
+        with self._lock:
+            self.hits += len(results)
+
+        if misses:
+            pool = _get_pool() if workers is None else ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context())
+            try:
+                futures = [(path, key, pool.submit(compute_fingerprint, path)) for path, key in misses]
+                rows = []
+                for path, key, future in futures:
+                    try:
+                        results[path] = future.result()
+                        rows.append((key, *results[path]))
+                    except acoustid.AcoustidError as e:
+                        log(f"Could not fingerprint '{os.path.basename(path)}': {e}")
+            finally:
+                if workers is not None:
+                    pool.shutdown()
+            self.set_many(rows)
+            with self._lock:
+                self.computed += len(rows)
+        return results
+
+    def fingerprint(self, path):
+        """Returns (duration, fingerprint) for one file, computing it in the pool on a miss."""
+        key = fingerprint_key(path)
+        cached = self.get(key) if key else None
+        if cached:
+            with self._lock:
+                self.hits += 1
+            return cached
+        duration, fingerprint = _get_pool().submit(compute_fingerprint, path).result()
+        if key:
+            self.set_many([(key, duration, fingerprint)])
+        with self._lock:
+            self.computed += 1
+        return duration, fingerprint
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+            return {"entries": entries, "hits": self.hits, "computed": self.computed}
+
+def _mp_context():
+    # The web app runs jobs in threads; forking a threaded process can deadlock the child
+    return multiprocessing.get_context("spawn")
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=config.FINGERPRINT_WORKERS, mp_context=_mp_context())
+        return _pool
+
+def lookup_batch(api_key, items):
+    """
+    Looks up several (duration, fingerprint) pairs in one AcoustID request.
+    Returns one list of raw AcoustID results per item, in order.
+    """
+    data = {"format": "json", "client": api_key, "meta": "recordings"}
+    if len(items) == 1:
+        data["duration"], data["fingerprint"] = int(items[0][0]), items[0][1]
+    else:
+        for index, (duration, fingerprint) in enumerate(items):
+            data[f"duration.{index}"] = int(duration)
+            data[f"fingerprint.{index}"] = fingerprint
+    try:
+        response = limited_post(ACOUSTID_LOOKUP_URL, data=data, timeout=30)
+        payload = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        raise acoustid.WebServiceError(f"lookup request failed: {e}")
+    if payload.get("status") != "ok":
+        raise acoustid.WebServiceError(payload.get("error", {}).get("message") or f"status: {payload.get('status')}")
+
+    if len(items) == 1:
+        return [payload.get("results", [])]
+    results = [[] for _ in items]
+    for entry in payload.get("fingerprints", []):
+        results[int(entry["index"])] = entry.get("results", [])
+    return results
+
+class AcoustIDBatcher:
+    """
+    Collects lookups from concurrent callers for up to `window` seconds (or
+    until `batch_size` are waiting) and sends them as one AcoustID request.
+    Each caller blocks until its own results are back.
+    """
+    def __init__(self, batch_size, window):
+        self.batch_size = batch_size
+        self.window = window
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.lookups = 0
+
+    def lookup(self, api_key, duration, fingerprint):
+        future = Future()
+        batch = None
+        with self._lock:
+            self._pending.append((api_key, duration, fingerprint, future))
+            if len(self._pending) >= self.batch_size:
+                batch = self._take()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._send(batch)
+        return future.result()
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self):
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    def _send(self, batch):
+        with self._lock:
+            self.requests += 1
+            self.lookups += len(batch)
+        try:
+            results = lookup_batch(batch[0][0], [(duration, fingerprint) for _, duration, fingerprint, _ in batch])
+        except Exception as e:
+            for *_, future in batch:
+                future.set_exception(e)
+            return
+        for (*_, future), result in zip(batch, results):
+            future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "lookups": self.lookups}
+
+_fingerprint_cache = None
+_batcher = AcoustIDBatcher(config.ACOUSTID_BATCH_SIZE, config.ACOUSTID_BATCH_WINDOW)
+_fingerprint_cache_lock = threading.Lock()
+
+def get_fingerprint_cache():
+    """Returns the process-wide FingerprintCache, or None when caching is disabled."""
+    global _fingerprint_cache
+    if not config.CACHE_ENABLED:
+        return None
+    with _fingerprint_cache_lock:
+        if _fingerprint_cache is None:
+            _fingerprint_cache = FingerprintCache(config.FINGERPRINT_DB_PATH)
+        return _fingerprint_cache
+
+def match_file(api_key, path):
+    """
+    Drop-in for acoustid.match: returns the (score, recording_id, title, artist)
+    tuples for a file, reusing the cached fingerprint and lookup when there is one.
+    """
+    fingerprint_cache = get_fingerprint_cache()
+    if fingerprint_cache:
+        duration, fingerprint = fingerprint_cache.fingerprint(path)
+    else:
+        duration, fingerprint = _get_pool().submit(compute_fingerprint, path).result()
+
+    response_cache = get_cache()
+    key = f"acoustid:{int(duration)}:{hashlib.sha1(fingerprint.encode('ascii')).hexdigest()}"
+    cached = response_cache.get(key, "acoustid", allow_expired=config.CACHE_OFFLINE) if response_cache else None
+    if cached:
+        results = json.loads(cached[0])
+    elif config.CACHE_OFFLINE:
+        raise OfflineCacheMiss(f"Offline mode: no cached AcoustID lookup for '{os.path.basename(path)}'")
+    else:
+        results = _batcher.lookup(api_key, duration, fingerprint)
+        if response_cache:
+            response_cache.set(key, "acoustid", json.dumps(results).encode("utf-8"), "application/json")
+    return list(acoustid.parse_lookup_result({"status": "ok", "results": results}))
+
+def stats():
+    fingerprint_cache = get_fingerprint_cache()
+    return {
+        "cache": fingerprint_cache.stats() if fingerprint_cache else None,
+        "lookups": _batcher.stats(),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fingerprint a library into the AcoustID fingerprint cache.")
+    parser.add_argument("root", nargs="?", default=config.DOWNLOAD_BASE_DIR, help="directory to scan (default: DOWNLOAD_BASE_DIR)")
+    parser.add_argument("--workers", type=int, default=None, help="fingerprinting processes (default: FINGERPRINT_WORKERS)")
+    args = parser.parse_args()
+    paths = [
+        os.path.join(dirpath, filename)
+        for dirpath, _, filenames in os.walk(args.root)
+        for filename in filenames
+        if os.path.splitext(filename)[1].lower() in EXPECTED_CONTAINERS
+    ]
+    started = time.perf_counter()
+    fingerprint_cache = FingerprintCache(config.FINGERPRINT_DB_PATH)
+    fingerprinted = fingerprint_cache.fingerprint_files(paths, workers=args.workers or config.FINGERPRINT_WORKERS)
+    print({"files": len(paths), "fingerprinted": len(fingerprinted), **fingerprint_cache.stats(),
+           "seconds": round(time.perf_counter() - started, 1)})
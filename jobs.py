@@ -0,0 +1,232 @@
+"""
+Background download jobs for the web UI.
+Submitting a job returns its id immediately; jobs are persisted to SQLite and run
+by a pool of workers on one long-lived asyncio event loop in a daemon thread, so
+several albums can download at once without pinning Flask request threads.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+import config
+import progress
+from pipeline import download_and_tag_pipeline
+from capabilities import get_capabilities
+from album_cache import get_album_cache
+from utils import log
+
+# Statuses match the badges in templates/downloads_dashboard.html
+STATUS_QUEUED = "starting"
+STATUS_RUNNING = "downloading"
+STATUS_COMPLETE = "complete"
+STATUS_ERROR = "error"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+
+class JobConflictError(Exception):
+    """Raised when an album folder already has an active job with different settings."""
+    def __init__(self, message, job_id):
+        super().__init__(message)
+        self.job_id = job_id
+
+def job_signature(payload):
+    """What makes two submits of the same album the same job: formats, MusicBrainz release and tracks."""
+    formats = payload["download_format"]
+    formats = [formats] if isinstance(formats, str) else formats
+    return (
+        sorted({str(name).upper() for name in formats}),
+        payload.get("selected_mb_release_id"),
+        sorted(str(item.get("id")) for item in payload["items_to_download"]),
+    )
+
+class JobStore:
+    """SQLite-backed record of every submitted job and its payload."""
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                album_title TEXT,
+                artist TEXT,
+                download_dir TEXT,
+                payload TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                end_time TEXT,
+                error_message TEXT
+            )"""
+        )
+        self._conn.commit()
+
+    def add(self, job_id, album_title, artist, download_dir, payload):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, album_title, artist, download_dir, payload, start_time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, STATUS_QUEUED, album_title, artist, download_dir, json.dumps(payload), datetime.now().isoformat())
+            )
+            self._conn.commit()
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            assignments = ", ".join(f"{name} = ?" for name in fields)
+            self._conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+            self._conn.commit()
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def find_active(self, download_dir):
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT * FROM jobs WHERE download_dir = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                (download_dir, *ACTIVE_STATUSES)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def list(self, limit=50):
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs ORDER BY start_time DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def unfinished(self):
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) ORDER BY start_time",
+                ACTIVE_STATUSES
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+class JobManager:
+    def __init__(self, store, workers=None, download_workers=None):
+        self.store = store
+        self.workers = workers or config.JOB_WORKERS
+        self.download_workers = download_workers or config.JOB_DOWNLOAD_CONCURRENCY
+        self._loop = None
+        self._queue = None
+        self._started = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self._run_loop, name="download-jobs", daemon=True)
+        thread.start()
+        self._started.wait()
+        # Pick up jobs interrupted by a restart
+        for job in self.store.unfinished():
+            log(f"Re-queueing unfinished job {job['id']} ({job['artist']} - {job['album_title']})")
+            self.store.update(job["id"], status=STATUS_QUEUED)
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, job["id"])
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue()
+        for _ in range(self.workers):
+            self._loop.create_task(self._worker())
+        self._started.set()
+        self._loop.run_forever()
+
+    def submit(self, items_to_download, download_dir, album_title, artist, selected_mb_release_id=None, download_format="FLAC", qobuz_album_data=None, qobuz_album_id=None):
+        """
+        Queues an album and returns its job id; an identical active job is reused.
+        Raises JobConflictError if the album's folder is still being written by
+        an active job with other formats, release or tracks.
+        With only qobuz_album_id, the album payload is read from the album cache when the job runs.
+        """
+        payload = {
+            "items_to_download": items_to_download,
+            "download_format": download_format,
+            "selected_mb_release_id": selected_mb_release_id,
+            "qobuz_album_data": qobuz_album_data,
+            "qobuz_album_id": qobuz_album_id,
+        }
+        existing = self.store.find_active(download_dir)
+        if existing:
+            # Both jobs would write (and tag) the same files, so they can't run side by side
+            if job_signature(json.loads(existing["payload"])) != job_signature(payload):
+                raise JobConflictError(
+                    f"'{artist} - {album_title}' is already downloading with different formats, release or tracks; "
+                    "start the new download once it has finished.",
+                    existing["id"]
+                )
+            return existing["id"]
+        job_id = uuid.uuid4().hex[:12]
+        self.store.add(job_id, album_title, artist, download_dir, payload)
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, job_id)
+        log(f"Queued job {job_id}: {artist} - {album_title} ({len(items_to_download)} tracks)")
+        return job_id
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run_job(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run_job(self, job_id):
+        job = self.store.get(job_id)
+        if not job or job["status"] not in ACTIVE_STATUSES:
+            return
+        payload = json.loads(job["payload"])
+        self.store.update(job_id, status=STATUS_RUNNING)
+        job_progress = progress.register(job_id)
+        try:
+            # Probed once per process (normally at startup), so this is a dict lookup
+            capabilities = await asyncio.get_running_loop().run_in_executor(None, get_capabilities)
+            acoustid_is_ready = capabilities["acoustid_key"]
+            fpcalc_ready_status = capabilities["fpcalc"]["available"]
+            # Full Qobuz album data gives the tagger its fallbacks; normally already cached by the selection step
+            qobuz_album_data = payload.get("qobuz_album_data")
+            if qobuz_album_data is None and payload.get("qobuz_album_id"):
+                qobuz_album_data, _ = await asyncio.get_running_loop().run_in_executor(None, get_album_cache().get, payload["qobuz_album_id"])
+            success = await download_and_tag_pipeline(
+                payload["items_to_download"],
+                payload["download_format"],
+                job["download_dir"],
+                qobuz_album_data,
+                acoustid_is_ready,
+                fpcalc_ready_status,
+                payload.get("selected_mb_release_id"),
+                download_workers=self.download_workers,
+                qobuz_album_id=payload.get("qobuz_album_id"),
+                job_progress=job_progress
+            )
+            if success:
+                self.store.update(job_id, status=STATUS_COMPLETE, end_time=datetime.now().isoformat())
+            else:
+                self.store.update(job_id, status=STATUS_ERROR, end_time=datetime.now().isoformat(), error_message="No tracks could be downloaded.")
+        except Exception as e:
+            log(f"Job {job_id} failed: {e}")
+            self.store.update(job_id, status=STATUS_ERROR, end_time=datetime.now().isoformat(), error_message=str(e))
+        finally:
+            job_progress.finished = True
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def list(self, limit=50):
+        return self.store.list(limit)
+
+    def active_count(self):
+        return len(self.store.unfinished())
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """Returns the process-wide JobManager, starting its event loop on first use."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(JobStore(config.JOBS_DB_PATH))
+            _manager.start()
+        return _manager
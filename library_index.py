@@ -0,0 +1,230 @@
+"""
+Persistent index of downloaded tracks, so duplicate and ownership checks are a
+SQLite lookup instead of a walk over DOWNLOAD_BASE_DIR.
+Rows are keyed by file path and indexed by Qobuz track/album id, ISRC and
+MusicBrainz recording id. The downloader records each finished file and the
+tagger fills in the IDs it resolves; `python library_index.py --rebuild` scans
+an existing library in parallel to (re)populate the index.
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mutagen
+
+import config
+from tag_writer import tag_keys
+from sync import EXPECTED_CONTAINERS, QOBUZ_TRACKID_KEYS, MUSICBRAINZ_TRACKID_KEYS, first_tag_value
+from utils import log
+
+# Tag keys (Vorbis / ID3 / MP4) read back when scanning existing files
+QOBUZ_ALBUMID_KEYS = tag_keys("qobuz_albumid")
+ISRC_KEYS = tag_keys("isrc")
+MUSICBRAINZ_RECORDINGID_KEYS = tag_keys("musicbrainz_recordingid")
+TITLE_KEYS = tag_keys("title")
+ARTIST_KEYS = tag_keys("artist")
+ALBUM_KEYS = tag_keys("album")
+
+COLUMNS = (
+    "path", "qobuz_track_id", "qobuz_album_id", "isrc", "mb_recording_id", "mb_track_id",
+    "title", "artist", "album", "format", "size", "mtime", "indexed_at",
+)
+
+class LibraryIndex:
+    def __init__(self, db_path):
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                qobuz_track_id TEXT,
+                qobuz_album_id TEXT,
+                isrc TEXT,
+                mb_recording_id TEXT,
+                mb_track_id TEXT,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                format TEXT,
+                size INTEGER,
+                mtime REAL,
+                indexed_at REAL NOT NULL
+            )"""
+        )
+        for column in ("qobuz_track_id", "qobuz_album_id", "isrc", "mb_recording_id"):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_tracks_{column} ON tracks({column})")
+        self._conn.commit()
+
+    def record(self, path, **fields):
+        """
+        Inserts or updates the row for a file. Fields left as None keep their
+        stored value, so the downloader and the tagger can each add what they know.
+        """
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+            fields.setdefault("size", stat.st_size)
+            fields.setdefault("mtime", stat.st_mtime)
+        except OSError:
+            pass
+        fields.setdefault("format", os.path.splitext(path)[1].lstrip(".").lower() or None)
+        row = {column: fields.get(column) for column in COLUMNS[1:-1]}
+        row = {column: (str(value) if column.endswith("_id") and value is not None else value) for column, value in row.items()}
+        with self._lock:
+            self._upsert([(path, *row.values(), time.time())])
+            self._conn.commit()
+
+    def _upsert(self, rows):
+        updates = ", ".join(f"{column} = COALESCE(excluded.{column}, {column})" for column in COLUMNS[1:])
+        self._conn.executemany(
+            f"INSERT INTO tracks ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))}) "
+            f"ON CONFLICT(path) DO UPDATE SET {updates}",
+            rows
+        )
+
+    def forget(self, path):
+        with self._lock:
+            self._conn.execute("DELETE FROM tracks WHERE path = ?", (os.path.abspath(path),))
+            self._conn.commit()
+
+    def find(self, qobuz_track_id=None, isrc=None, mb_recording_id=None):
+        """Returns the first indexed file matching any of the given IDs, or None."""
+        for column, value in (("qobuz_track_id", qobuz_track_id), ("isrc", isrc), ("mb_recording_id", mb_recording_id)):
+            if not value:
+                continue
+            with self._lock:
+                row = self._conn.execute(f"SELECT * FROM tracks WHERE {column} = ? LIMIT 1", (str(value),)).fetchone()
+            if row:
+                return dict(row)
+        return None
+
+    def owned_track_ids(self, qobuz_track_ids):
+        ids = [str(track_id) for track_id in qobuz_track_ids if track_id]
+        if not ids:
+            return set()
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT DISTINCT qobuz_track_id FROM tracks WHERE qobuz_track_id IN ({', '.join('?' * len(ids))})", ids
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def owned_album_track_counts(self, qobuz_album_ids):
+        """Maps each given album id that has indexed files to its number of distinct tracks."""
+        ids = [str(album_id) for album_id in qobuz_album_ids if album_id]
+        if not ids:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT qobuz_album_id, COUNT(DISTINCT COALESCE(qobuz_track_id, path)) FROM tracks "
+                f"WHERE qobuz_album_id IN ({', '.join('?' * len(ids))}) GROUP BY qobuz_album_id", ids
+            ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def stats(self):
+        with self._lock:
+            tracks, albums, total = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT qobuz_album_id), COALESCE(SUM(size), 0) FROM tracks"
+            ).fetchone()
+        return {"tracks": tracks, "albums": albums, "bytes": total}
+
+    def rebuild(self, root, workers=None):
+        """
+        Scans every audio file under root in a process pool and refreshes the index.
+        Files whose size and mtime are unchanged since they were indexed are skipped,
+        and rows for files that no longer exist under root are removed.
+        """
+        started = time.perf_counter()
+        root = os.path.abspath(root)
+        # Prefix compare rather than LIKE, which would treat '_'/'%' in folder names as wildcards
+        prefix = root + os.sep
+        with self._lock:
+            known = {
+                row["path"]: (row["size"], row["mtime"])
+                for row in self._conn.execute(
+                    "SELECT path, size, mtime FROM tracks WHERE substr(path, 1, length(?)) = ?", (prefix, prefix)
+                )
+            }
+
+        found, to_scan = set(), []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() not in EXPECTED_CONTAINERS:
+                    continue
+                path = os.path.join(dirpath, filename)
+                found.add(path)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if known.get(path) != (stat.st_size, stat.st_mtime):
+                    to_scan.append(path)
+
+        rows = []
+        if to_scan:
+            with ProcessPoolExecutor(max_workers=workers or config.LIBRARY_SCAN_WORKERS) as pool:
+                rows = [row for row in pool.map(scan_file, to_scan, chunksize=32) if row]
+
+        removed = [path for path in known if path not in found]
+        with self._lock:
+            self._upsert(rows)
+            self._conn.executemany("DELETE FROM tracks WHERE path = ?", ((path,) for path in removed))
+            self._conn.commit()
+        log(f"Library index: {len(found)} files under '{root}', {len(rows)} (re)indexed, "
+            f"{len(removed)} removed in {time.perf_counter() - started:.1f}s")
+        return {"files": len(found), "indexed": len(rows), "removed": len(removed)}
+
+def scan_file(path):
+    """Reads the IDs and basic tags of one file into an index row; runs in a worker process."""
+    try:
+        stat = os.stat(path)
+        audio = mutagen.File(path)
+    except (OSError, mutagen.MutagenError):
+        return None
+    tags = getattr(audio, "tags", None) or {}
+    return (
+        path,
+        first_tag_value(tags, QOBUZ_TRACKID_KEYS),
+        first_tag_value(tags, QOBUZ_ALBUMID_KEYS),
+        first_tag_value(tags, ISRC_KEYS),
+        first_tag_value(tags, MUSICBRAINZ_RECORDINGID_KEYS),
+        first_tag_value(tags, MUSICBRAINZ_TRACKID_KEYS),
+        first_tag_value(tags, TITLE_KEYS),
+        first_tag_value(tags, ARTIST_KEYS),
+        first_tag_value(tags, ALBUM_KEYS),
+        os.path.splitext(path)[1].lstrip(".").lower(),
+        stat.st_size,
+        stat.st_mtime,
+        time.time(),
+    )
+
+_library = None
+_library_lock = threading.Lock()
+
+def get_library():
+    """Returns the process-wide LibraryIndex, or None when the index is disabled."""
+    global _library
+    if not config.LIBRARY_INDEX_ENABLED:
+        return None
+    with _library_lock:
+        if _library is None:
+            _library = LibraryIndex(config.LIBRARY_DB_PATH)
+        return _library
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the local library index.")
+    parser.add_argument("--rebuild", nargs="?", const=config.DOWNLOAD_BASE_DIR, metavar="DIR",
+                        help="scan DIR (default: DOWNLOAD_BASE_DIR) and refresh the index")
+    parser.add_argument("--workers", type=int, default=None, help="scanner processes (default: LIBRARY_SCAN_WORKERS)")
+    args = parser.parse_args()
+    library = LibraryIndex(config.LIBRARY_DB_PATH)
+    if args.rebuild:
+        print(library.rebuild(args.rebuild, workers=args.workers))
+    print(library.stats())
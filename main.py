@@ -10,10 +10,11 @@ from tqdm import tqdm
 
 # Import functions from our new modules
 import config
-from qobuz_api import get_music_info, get_album_details
-from downloader import main_download_orchestrator
-from tagger import tag_file_with_musicbrainz_api, check_fpcalc_readiness, tag_file_worker, MusicBrainzRateLimiter
+from qobuz_api import get_music_info, get_album_details, QobuzAPIError
+from pipeline import download_and_tag_pipeline
+from capabilities import fpcalc_ready, unavailable_formats
 from utils import clean_filename, log
+from response_cache import cached_get
 
 # Global variable for fpcalc readiness
 _fpcalc_ready_status = False
@@ -36,8 +37,8 @@ async def main_async():
     else:
         acoustid_is_ready = True
 
-    # Check fpcalc readiness once
-    _fpcalc_ready_status = check_fpcalc_readiness()
+    # Check fpcalc (and ffmpeg encoders) once
+    _fpcalc_ready_status = fpcalc_ready()
 
     while True:
         search_term = input("Enter search query (e.g., 'Daft Punk Discovery') or 'quit' to exit: ").strip()
@@ -53,7 +54,11 @@ async def main_async():
             print("Invalid choice. Defaulting to albums.")
             search_type = "albums"
 
-        found_items = get_music_info(search_term, music_type=search_type, limit=20)
+        try:
+            found_items = get_music_info(search_term, music_type=search_type, limit=20)
+        except (QobuzAPIError, requests.exceptions.RequestException) as e:
+            print(f"Search failed: {e}")
+            continue
 
         if found_items:
             print("\n--- Search Results ---")
@@ -142,11 +147,10 @@ async def main_async():
                                     mb_headers = {"User-Agent": config.MUSICBRAINZ_USER_AGENT}
 
                                     try:
-                                        mb_release_search_response = requests.get(mb_release_search_url, params=mb_release_search_params, headers=mb_headers)
+                                        mb_release_search_response = cached_get(mb_release_search_url, params=mb_release_search_params, headers=mb_headers, endpoint="musicbrainz")
                                         mb_release_search_response.raise_for_status()
                                         mb_release_search_data = mb_release_search_response.json()
                                         config.SESSION_COOKIES.update(mb_release_search_response.cookies.get_dict()) # Example: Capture cookies if needed
-                                        time.sleep(1) # Be nice to MusicBrainz API
 
                                         available_releases = mb_release_search_data.get('releases', [])
 
@@ -226,7 +230,16 @@ async def main_async():
 
                             # --- Moved download_format input outside of the album/track specific blocks ---
                             if items_to_download: # Only ask for format if there are items to download
-                                download_format = input("Enter desired download format (e.g., FLAC, MP3, ALAC): ").strip().upper()
+                                while True:
+                                    download_format = [name.strip().upper() for name in input(f"Enter desired download format(s), comma-separated ({', '.join(config.TRANSCODE_MAP)}): ").split(",") if name.strip()] or ["FLAC"]
+                                    unknown = [name for name in download_format if name not in config.TRANSCODE_MAP]
+                                    if not unknown:
+                                        break
+                                    print(f"Unknown format(s): {', '.join(unknown)}. Choose from {', '.join(config.TRANSCODE_MAP)}.")
+                                for name, reason in unavailable_formats(download_format).items():
+                                    print(f"Skipping format {name}: {reason}.")
+                                    download_format.remove(name)
+                                download_format = download_format or ["FLAC"]
 
                                 downloads_successful = await download_and_tag_all(
                                     items_to_download,
@@ -263,41 +276,11 @@ async def download_and_tag_all(
     acoustid_is_ready,
     fpcalc_ready_status
 ):
-    file_ready_queue = asyncio.Queue()
-    rate_limiter = MusicBrainzRateLimiter(min_interval=1.0)
-    num_files = len(items_to_download)
-
-    # --- Download all files first ---
-    await main_download_orchestrator(
+    return await download_and_tag_pipeline(
         items_to_download,
         download_format,
         current_download_dir,
-        file_ready_queue=file_ready_queue
+        qobuz_album_data_for_tagging,
+        acoustid_is_ready,
+        fpcalc_ready_status
     )
-
-    # --- Prepare list of downloaded files for tagging ---
-    downloaded_files = []
-    while not file_ready_queue.empty():
-        downloaded_files.append(await file_ready_queue.get())
-
-    # --- Tagging progress bar ---
-    for file_info in downloaded_files:
-        audio_file_path, download_format = file_info
-        filename_only = os.path.basename(audio_file_path)
-        track_data_for_this_file = None
-        for q_track_data in items_to_download:
-            expected_filename = f"{clean_filename(q_track_data['artist'])} - {clean_filename(q_track_data['title'])}.{download_format.lower()}"
-            if expected_filename == filename_only:
-                track_data_for_this_file = q_track_data
-                break
-        await rate_limiter.wait()
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            None,
-            tag_file_with_musicbrainz_api,
-            audio_file_path,
-            qobuz_album_data_for_tagging,
-            track_data_for_this_file,
-            acoustid_is_ready,
-            fpcalc_ready_status
-        )
\ No newline at end of file
@@ -0,0 +1,179 @@
+"""
+Health-aware routing across the Qobuz API mirrors (config.QOBUZ_API_BASE_URLS).
+Each mirror keeps a rolling window of recent request latencies and outcomes
+(older than MIRROR_SAMPLE_MAX_AGE they no longer count, so a mirror that failed
+once is tried again once the failure has aged out). Requests go to the fastest
+healthy mirror first; a mirror failing MIRROR_FAILURE_THRESHOLD
+times in a row is circuit-broken for MIRROR_COOLDOWN seconds and then gets one
+trial request. Optionally, a request still running past the primary's latency
+percentile is hedged to the next mirror and the first good answer wins.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+
+import aiohttp
+
+import config
+from utils import log
+
+def describe_error(e):
+    if isinstance(e, aiohttp.ClientResponseError):
+        return f"HTTP {e.status}"
+    if isinstance(e, asyncio.TimeoutError):
+        return "timed out"
+    return str(e) or type(e).__name__
+
+def is_mirror_fault(e):
+    """5xx, timeouts, connection and parse errors count against a mirror; 4xx answers don't."""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500
+    return True
+
+class MirrorHealth:
+    def __init__(self, base_url, window):
+        self.base_url = base_url
+        self.samples = deque(maxlen=window)  # (monotonic time, latency seconds, ok)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.hedged = 0
+
+    def record(self, latency, ok):
+        self.samples.append((time.monotonic(), latency, ok))
+        self.requests += 1
+        if ok:
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+        else:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= config.MIRROR_FAILURE_THRESHOLD:
+                if not self.open_until:
+                    log(f"Qobuz API mirror {self.base_url} failed {self.consecutive_failures} times in a row; "
+                        f"pausing it for {config.MIRROR_COOLDOWN:.0f}s")
+                self.open_until = time.monotonic() + config.MIRROR_COOLDOWN
+
+    def is_open(self, now):
+        return self.open_until > now
+
+    def recent(self):
+        cutoff = time.monotonic() - config.MIRROR_SAMPLE_MAX_AGE
+        return [(latency, ok) for at, latency, ok in self.samples if at >= cutoff]
+
+    def error_rate(self):
+        samples = self.recent()
+        if not samples:
+            return 0.0
+        return sum(1 for _, ok in samples if not ok) / len(samples)
+
+    def latency_percentile(self, percentile):
+        latencies = sorted(latency for latency, ok in self.recent() if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    def score(self):
+        """Lower is better: median latency inflated by the recent error rate. Untried (or long idle) mirrors score 0."""
+        median = self.latency_percentile(50) or 0.0
+        return median * (1 + 4 * self.error_rate()) + self.error_rate()
+
+    def stats(self, now):
+        p50, p95 = self.latency_percentile(50), self.latency_percentile(95)
+        return {
+            "requests": self.requests,
+            "error_rate": round(self.error_rate(), 3),
+            "p50": round(p50, 3) if p50 is not None else None,
+            "p95": round(p95, 3) if p95 is not None else None,
+            "circuit_open": self.is_open(now),
+            "hedged": self.hedged,
+        }
+
+class MirrorPool:
+    def __init__(self, base_urls, window=None):
+        self._lock = threading.Lock()
+        self._mirrors = [MirrorHealth(base_url.rstrip("/"), window or config.MIRROR_WINDOW) for base_url in base_urls]
+
+    def ordered(self):
+        """Healthy mirrors fastest first (config order breaks ties), then circuit-broken ones as a last resort."""
+        now = time.monotonic()
+        with self._lock:
+            healthy = sorted((m for m in self._mirrors if not m.is_open(now)), key=lambda m: m.score())
+            broken = sorted((m for m in self._mirrors if m.is_open(now)), key=lambda m: m.open_until)
+        return healthy + broken
+
+    def record(self, mirror, latency, ok):
+        with self._lock:
+            mirror.record(latency, ok)
+
+    def hedge_delay(self, mirror):
+        """Seconds to wait on `mirror` before hedging, or None when hedging is off or there's too little data."""
+        if not config.MIRROR_HEDGE_PERCENTILE:
+            return None
+        with self._lock:
+            if sum(1 for _, ok in mirror.recent() if ok) < config.MIRROR_HEDGE_MIN_SAMPLES:
+                return None
+            return mirror.latency_percentile(config.MIRROR_HEDGE_PERCENTILE)
+
+    async def request(self, fetch):
+        """
+        Runs fetch(base_url) against the mirrors in health order until one succeeds,
+        hedging a slow primary once. Returns the result; raises the last error if
+        every mirror fails, or straight away on a 4xx, which another mirror won't fix.
+        """
+        candidates = self.ordered()
+        pending = {}
+        last_exception = None
+        hedged = False
+
+        def launch(mirror):
+            pending[asyncio.ensure_future(self._timed(mirror, fetch))] = mirror
+
+        launch(candidates.pop(0))
+        try:
+            while pending:
+                delay = None
+                if not hedged and candidates and len(pending) == 1:
+                    delay = self.hedge_delay(next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Primary is slower than usual: race the next mirror against it
+                    hedged = True
+                    slow = next(iter(pending.values()))
+                    with self._lock:
+                        slow.hedged += 1
+                    log(f"Qobuz API mirror {slow.base_url} slower than p{config.MIRROR_HEDGE_PERCENTILE}; hedging to {candidates[0].base_url}")
+                    launch(candidates.pop(0))
+                    continue
+                for task in done:
+                    pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_exception = task.exception()
+                    if not is_mirror_fault(last_exception):
+                        raise last_exception
+                if not pending and candidates:
+                    launch(candidates.pop(0))
+        finally:
+            for task in pending:
+                task.cancel()
+        raise last_exception
+
+    async def _timed(self, mirror, fetch):
+        started = time.monotonic()
+        try:
+            result = await fetch(mirror.base_url)
+        except asyncio.CancelledError:
+            # Lost a hedge race or the caller gave up: says nothing about the mirror, so not a sample
+            raise
+        except Exception as e:
+            log(f"Qobuz API mirror {mirror.base_url} failed: {describe_error(e)}")
+            self.record(mirror, time.monotonic() - started, not is_mirror_fault(e))
+            raise
+        self.record(mirror, time.monotonic() - started, True)
+        return result
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {mirror.base_url: mirror.stats(now) for mirror in self._mirrors}
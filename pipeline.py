@@ -0,0 +1,68 @@
+import asyncio
+
+import config
+from downloader import main_download_orchestrator
+from tagger import tag_file_worker, AlbumMetadataContext
+from utils import log
+
+async def download_and_tag_pipeline(
+    items_to_download,
+    download_format,
+    current_download_dir,
+    qobuz_album_data_for_tagging,
+    acoustid_is_ready,
+    fpcalc_ready_status,
+    selected_mb_release_id=None,
+    download_workers=None,
+    tag_workers=None,
+    job_progress=None,
+    skip_existing=None,
+    retag_existing=None,
+    qobuz_album_id=None
+):
+    """
+    Runs downloads and tagging as a producer/consumer pipeline: each finished
+    file is handed to a pool of tag workers while the rest of the album is still
+    downloading. The bounded queue applies backpressure to the downloaders when
+    tagging falls behind.
+    """
+    tag_workers = tag_workers or config.TAG_WORKERS
+    file_ready_queue = asyncio.Queue(maxsize=config.TAG_QUEUE_SIZE)
+    # Release JSON and cover art are resolved once and shared by every track
+    album_context = AlbumMetadataContext()
+
+    workers = [
+        asyncio.create_task(tag_file_worker(
+            file_ready_queue,
+            qobuz_album_data_for_tagging,
+            items_to_download,
+            acoustid_is_ready,
+            fpcalc_ready_status,
+            selected_mb_release_id=selected_mb_release_id,
+            album_context=album_context,
+            job_progress=job_progress
+        ))
+        for _ in range(tag_workers)
+    ]
+    log(f"Started download/tag pipeline with {tag_workers} tag worker(s).")
+
+    try:
+        downloads_successful = await main_download_orchestrator(
+            items_to_download,
+            download_format,
+            current_download_dir,
+            file_ready_queue=file_ready_queue,
+            max_concurrency=download_workers,
+            job_progress=job_progress,
+            skip_existing=skip_existing,
+            retag_existing=retag_existing,
+            qobuz_album_id=qobuz_album_id or (qobuz_album_data_for_tagging or {}).get("id")
+        )
+    finally:
+        for _ in workers:
+            await file_ready_queue.put(None)
+        await asyncio.gather(*workers)
+        if job_progress:
+            job_progress.finished = True
+
+    return downloads_successful
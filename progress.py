@@ -0,0 +1,160 @@
+"""
+Per-track and per-job progress for running downloads.
+TrackProgress is duck-typed like a tqdm bar (update / reset / set_description) so it
+plugs into download_music_async's overall_pbar hook; JobProgress aggregates tracks
+into bytes, throughput, ETA and stage for the web UI's JSON/SSE endpoints.
+"""
+import os
+import threading
+import time
+
+# Stages a track moves through, in order
+STAGE_QUEUED = "queued"
+STAGE_RESOLVING = "resolving"
+STAGE_DOWNLOADING = "downloading"
+STAGE_TRANSCODING = "transcoding"
+STAGE_TAGGING = "tagging"
+STAGE_DONE = "done"
+STAGE_FAILED = "failed"
+
+# Share of a track's overall progress reached when it enters each stage
+STAGE_WEIGHTS = {
+    STAGE_QUEUED: 0.0,
+    STAGE_RESOLVING: 0.0,
+    STAGE_DOWNLOADING: 0.0,
+    STAGE_TRANSCODING: 0.8,
+    STAGE_TAGGING: 0.85,
+    STAGE_DONE: 1.0,
+    STAGE_FAILED: 1.0,
+}
+DOWNLOAD_WEIGHT = 0.8
+
+class TrackProgress:
+    def __init__(self, title, lock):
+        self.title = title
+        self.stage = STAGE_QUEUED
+        self.bytes = 0
+        self.total = 0
+        self.started = None
+        self.updated = None
+        self._lock = lock
+
+    # tqdm-compatible hooks used by download_music_async
+    def reset(self, total=None):
+        with self._lock:
+            self.bytes = 0
+            self.total = total or 0
+            self.started = self.updated = time.monotonic()
+            self.stage = STAGE_DOWNLOADING
+
+    def update(self, n=1):
+        with self._lock:
+            self.bytes += n
+            self.updated = time.monotonic()
+
+    def set_description(self, stage):
+        with self._lock:
+            self.stage = stage
+            self.updated = time.monotonic()
+
+    def fraction(self):
+        if self.stage == STAGE_DOWNLOADING and self.total:
+            return min(1.0, self.bytes / self.total) * DOWNLOAD_WEIGHT
+        return STAGE_WEIGHTS.get(self.stage, 0.0)
+
+    def snapshot(self, now):
+        elapsed = (self.updated or now) - self.started if self.started else 0
+        throughput = self.bytes / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.bytes) / throughput if throughput and self.total > self.bytes else None
+        return {
+            "title": self.title,
+            "stage": self.stage,
+            "bytes": self.bytes,
+            "total": self.total,
+            "throughput": round(throughput),
+            "eta": round(eta, 1) if eta is not None else None,
+            "percent": round(self.fraction() * 100, 1),
+            "stalled_for": round(now - self.updated, 1) if self.updated and self.stage == STAGE_DOWNLOADING else 0,
+        }
+
+class TrackGroup:
+    """Forwards the download hooks to several TrackProgress rows: the profiles fanned out from one download."""
+    def __init__(self, tracks):
+        self.tracks = tracks
+
+    def reset(self, total=None):
+        for track in self.tracks:
+            track.reset(total)
+
+    def update(self, n=1):
+        for track in self.tracks:
+            track.update(n)
+
+    def set_description(self, stage):
+        for track in self.tracks:
+            track.set_description(stage)
+
+def progress_key(path, profile):
+    """Progress row id for one output: the file stem is shared by every profile of a fanned-out track."""
+    return f"{os.path.splitext(os.path.basename(path))[0]} [{profile.upper()}]"
+
+class JobProgress:
+    def __init__(self):
+        self.tracks = {}
+        self.started = time.monotonic()
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def track(self, track_id, title):
+        with self._lock:
+            if track_id not in self.tracks:
+                self.tracks[track_id] = TrackProgress(title, self._lock)
+            return self.tracks[track_id]
+
+    def set_stage(self, track_id, stage):
+        track = self.tracks.get(track_id)
+        if track:
+            track.set_description(stage)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            tracks = {str(track_id): track.snapshot(now) for track_id, track in self.tracks.items()}
+            total_bytes = sum(t.bytes for t in self.tracks.values())
+            expected_bytes = sum(t.total for t in self.tracks.values())
+            first_byte = min((t.started for t in self.tracks.values() if t.started), default=None)
+            percent = (sum(t.fraction() for t in self.tracks.values()) / len(self.tracks) * 100) if self.tracks else 0
+        elapsed = now - first_byte if first_byte else 0
+        throughput = total_bytes / elapsed if elapsed > 0 else 0
+        eta = (expected_bytes - total_bytes) / throughput if throughput and expected_bytes > total_bytes else None
+        stages = {}
+        for track in tracks.values():
+            stages[track["stage"]] = stages.get(track["stage"], 0) + 1
+        return {
+            "finished": self.finished,
+            "percent": round(percent, 1),
+            "bytes": total_bytes,
+            "total": expected_bytes,
+            "throughput": round(throughput),
+            "eta": round(eta, 1) if eta is not None else None,
+            "elapsed": round(now - self.started, 1),
+            "stages": stages,
+            "tracks": tracks,
+        }
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+MAX_TRACKED_JOBS = 100
+
+def register(job_id):
+    with _jobs_lock:
+        _jobs[job_id] = JobProgress()
+        # Forget the oldest finished jobs once the registry grows past its cap
+        finished = [key for key, job in _jobs.items() if job.finished]
+        for key in finished[:max(0, len(_jobs) - MAX_TRACKED_JOBS)]:
+            del _jobs[key]
+        return _jobs[job_id]
+
+def get(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id)
@@ -1,209 +1,322 @@
+import asyncio
+import atexit
+import threading
 import requests
 import json
+import aiohttp
 from tqdm.asyncio import tqdm
-import config # Import config for API_HEADERS, BASE_URL, QUALITY_MAP, SESSION_COOKIES
+import config # Import config for API_HEADERS, QOBUZ_API_BASE_URLS, SESSION_COOKIES
 from utils import log
-from config import QOBUZ_API_BASE_URLS
+from response_cache import get_cache, cache_key, OfflineCacheMiss
+from mirror_pool import MirrorPool, describe_error, is_mirror_fault
 
-def try_endpoints(path, params=None, headers=None):
-    last_exception = None
-    for base_url in QOBUZ_API_BASE_URLS:
-        url = f"{base_url}{path}"
-        try:
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            response.raise_for_status()  # Raises for 4xx/5xx
-            return response
-        except Exception as e:
-            # Optionally log the failure here
-            last_exception = e
-            continue
-    raise last_exception
+class QobuzAPIError(Exception):
+    """Raised when no Qobuz API mirror returned a usable response."""
 
-def get_music_info(query, music_type="albums", offset=0, limit=10):
+class QobuzClient:
     """
-    Searches for music (albums or tracks) and returns a list of dictionaries with their details.
+    Async client for the squid.wtf Qobuz API with one pooled keep-alive session.
+    The session lives on the client's own event loop thread, so Flask request
+    threads (via run) and the download job loop (via call) share connections.
+    Every request has a timeout and is routed by the MirrorPool across
+    QOBUZ_API_BASE_URLS; responses go through the persistent response cache.
     """
-    path = f"/api/get-music"
-    params = {"q": query, "offset": offset, "limit": limit}
-    response = try_endpoints(path, params=params, headers=config.API_HEADERS)
+    def __init__(self, mirrors, timeout, connections):
+        self.mirrors = mirrors
+        self.timeout = timeout
+        self.connections = connections
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
 
-    try:
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="qobuz-api", daemon=True).start()
+            return self._loop
+
+    def _submit(self, coros):
+        async def gather():
+            return await asyncio.gather(*coros)
+        return asyncio.run_coroutine_threadsafe(gather(), self._ensure_loop())
+
+    def run(self, coro, *more):
+        """
+        Runs client coroutines from synchronous code (Flask routes, the CLI) and
+        returns the result, or a list of results when several are issued concurrently.
+        """
+        results = self._submit((coro, *more)).result()
+        return results if more else results[0]
+
+    async def call(self, coro, *more):
+        """Like run, but awaited from another event loop (e.g. the download job runner)."""
+        results = await asyncio.wrap_future(self._submit((coro, *more)))
+        return results if more else results[0]
+
+    def close(self):
+        """Closes the pooled session; registered to run at interpreter exit."""
+        with self._lock:
+            loop, session = self._loop, self._session
+        if loop and session and not session.closed:
+            asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connections,
+                ttl_dns_cache=config.DOWNLOAD_DNS_CACHE_TTL,
+                keepalive_timeout=config.DOWNLOAD_KEEPALIVE_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, headers=config.API_HEADERS)
+        return self._session
+
+    async def _fetch(self, url, params=None, headers=None, timeout=None):
+        """GETs url and returns (parsed JSON, raw body, content type); HTTP errors raise aiohttp.ClientResponseError."""
+        params = {name: str(value) for name, value in (params or {}).items()}
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        async with self._get_session().get(url, params=params, headers=headers, timeout=client_timeout) as response:
+            response.raise_for_status()
+            body = await response.read()
+            content_type = response.headers.get("Content-Type")
+        return json.loads(body), body, content_type
+
+    async def _cached(self, key, endpoint, fetch):
+        """Serves key from the response cache, or awaits fetch() and stores its (successful) response."""
+        cache = get_cache()
+        if cache:
+            cached = cache.get(key, endpoint, allow_expired=config.CACHE_OFFLINE)
+            if cached:
+                return json.loads(cached[0])
+        if config.CACHE_OFFLINE:
+            raise OfflineCacheMiss(f"Offline mode: no cached response for {key}")
+        data, body, content_type = await fetch()
+        if cache and body:
+            cache.set(key, endpoint, body, content_type)
+        return data
+
+    async def _mirrored(self, path, fetch_from):
+        try:
+            return await self.mirrors.request(fetch_from)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            if not is_mirror_fault(e):
+                raise QobuzAPIError(f"Qobuz API rejected {path}: {describe_error(e)}")
+            raise QobuzAPIError(f"All Qobuz API mirrors failed for {path}: {describe_error(e)}")
+
+    async def get_json(self, url, params=None, headers=None, endpoint="default", timeout=None):
+        """GETs a JSON document from a fixed URL (not mirrored), through the response cache."""
+        return await self._cached(cache_key(url, params), endpoint, lambda: self._fetch(url, params, headers, timeout))
+
+    async def get_mirrored(self, path, params=None, endpoint="default", timeout=None):
+        """GETs path from the best available mirror; raises QobuzAPIError if none answers."""
+        # Keyed by path so a response cached from any mirror is reused
+        return await self._cached(cache_key(path, params), endpoint, lambda: self._mirrored(
+            path, lambda base_url: self._fetch(f"{base_url}{path}", params, timeout=timeout)
+        ))
+
+    async def search(self, query, music_type="albums", offset=0, limit=10):
         tqdm.write(f"Searching for {music_type} with query: '{query}'...")
-        response.raise_for_status()
-
-        data = response.json()
-
-        if data.get("success") and data.get("data"):
-            music_results = data["data"].get(music_type)
-            if music_results and music_results.get("items"):
-                tqdm.write(f"Found {music_results['total']} {music_results['total']} {music_type} for '{query}'.")
-
-                processed_items = []
-                for item in music_results["items"]:
-                    item_id = item.get("id")
-                    item_title = item.get("title", item.get("name", "N/A Title"))
-
-                    item_artist = "N/A Artist"
-                    if "artist" in item and "name" in item["artist"]:
-                        item_artist = item["artist"]["name"]
-                    elif "album_artist" in item:
-                        item_artist = item["album_artist"]
-
-                    determined_type = "album" if music_type == "albums" else "track"
-
-                    item_release_date = item.get("release_date") or item.get("album", {}).get("release_date")
-
-                    processed_items.append({
-                        "id": item_id,
-                        "title": item_title,
-                        "artist": item_artist,
-                        "type": determined_type,
-                        "release_date": item_release_date,
-                        "raw_data": item
-                    })
-                return processed_items
-            else:
-                tqdm.write(f"No {music_type} found for query: '{query}'")
-                return []
-        else:
-            tqdm.write("Search request was not successful or data format is unexpected.")
-            return []
+        data = await self.get_mirrored("/api/get-music", {"q": query, "offset": offset, "limit": limit}, endpoint="qobuz_search")
+        return parse_search_results(data, query, music_type)
+
+    async def album(self, album_id):
+        data = await self.get_mirrored("/api/get-album", {"album_id": album_id}, endpoint="qobuz_album")
+        return parse_album(data)
+
+    async def cdn_url(self, track_id, quality):
+        """Signed CDN URL for one track. Never cached: the URLs expire."""
+        path = "/api/download-music"
+        params = {"track_id": track_id, "quality": quality}
+        data, _, _ = await self._mirrored(path, lambda base_url: self._fetch(f"{base_url}{path}", params, timeout=config.RESOLVE_TIMEOUT))
+        return data.get("data", {}).get("url")
+
+    async def search_direct(self, query, music_type="albums", limit=10):
+        params = {
+            "query": query,
+            "type": music_type,
+            "limit": limit,
+            "app_id": "285473059",  # Public app ID (may need updating)
+        }
+        data = await self.get_json(QOBUZ_DIRECT_SEARCH_URL, params, headers=QOBUZ_DIRECT_HEADERS, endpoint="qobuz_search")
+        return parse_direct_search_results(data, music_type, limit)
 
-    except requests.exceptions.RequestException as e:
-        tqdm.write(f"Error during search: {e}")
+    async def search_with_fallback(self, query, music_type="albums", offset=0, limit=10):
+        """
+        Starts every search strategy at once: the query itself, the direct Qobuz
+        search, then the term variations. The first strategy (in that order of
+        preference) to come back non-empty wins; results already in from the
+        others are merged in, and the rest are cancelled.
+        """
+        strategies = [
+            ("squid.wtf proxy", self.search(query, music_type, offset, limit)),
+            ("direct Qobuz search", self.search_direct(query, music_type, limit)),
+        ]
+        strategies += [
+            (f"variation '{variation}'", self.search(variation, music_type, offset, limit))
+            for variation in generate_search_variations(query) if variation != query
+        ]
+        tasks = [asyncio.ensure_future(coro) for _, coro in strategies]
+        try:
+            for index, ((label, _), task) in enumerate(zip(strategies, tasks)):
+                try:
+                    results = await task
+                except Exception as e:
+                    tqdm.write(f"Search via {label} failed: {e}")
+                    continue
+                if not results:
+                    continue
+                finished = [t.result() for t in tasks[index + 1:] if t.done() and not t.cancelled() and not t.exception()]
+                merged = merge_results([results, *finished], limit)
+                tqdm.write(f"Found {len(merged)} unique results using {label}")
+                return merged
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # mark as retrieved, the failure was already reported or superseded
+        tqdm.write("All search methods failed")
         return []
-    except json.JSONDecodeError:
-        tqdm.write("Failed to decode JSON response from search.")
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Returns the process-wide QobuzClient."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = QobuzClient(MirrorPool(config.QOBUZ_API_BASE_URLS), config.QOBUZ_API_TIMEOUT, config.QOBUZ_API_CONNECTIONS)
+            atexit.register(_client.close)
+        return _client
+
+def parse_search_results(data, query, music_type="albums"):
+    """Turns a /api/get-music response into the item dicts used by the UI and the CLI."""
+    if data.get("success") and data.get("data"):
+        music_results = data["data"].get(music_type)
+        if music_results and music_results.get("items"):
+            tqdm.write(f"Found {music_results['total']} {music_type} for '{query}'.")
+
+            processed_items = []
+            for item in music_results["items"]:
+                item_id = item.get("id")
+                item_title = item.get("title", item.get("name", "N/A Title"))
+
+                item_artist = "N/A Artist"
+                if "artist" in item and "name" in item["artist"]:
+                    item_artist = item["artist"]["name"]
+                elif "album_artist" in item:
+                    item_artist = item["album_artist"]
+
+                determined_type = "album" if music_type == "albums" else "track"
+
+                item_release_date = item.get("release_date") or item.get("album", {}).get("release_date")
+
+                processed_items.append({
+                    "id": item_id,
+                    "title": item_title,
+                    "artist": item_artist,
+                    "type": determined_type,
+                    "release_date": item_release_date,
+                    "raw_data": item
+                })
+            return processed_items
+        else:
+            tqdm.write(f"No {music_type} found for query: '{query}'")
+            return []
+    else:
+        tqdm.write("Search request was not successful or data format is unexpected.")
         return []
 
+def parse_album(data):
+    """Returns (album_data, tracks) from a /api/get-album response, or (None, [])."""
+    if data.get("success") and data.get("data"):
+        album_data = data["data"]
+        album_artist_name = album_data.get('artist', {}).get('name', 'N/A')
+        tqdm.write(f"Album: {album_data.get('title', 'N/A')} by {album_artist_name}")
+
+        tracks = []
+        if album_data.get("tracks") and album_data["tracks"].get("items"):
+            tqdm.write("Tracks:")
+            for i, track_item in enumerate(album_data["tracks"]["items"]):
+                track_id = track_item.get("id")
+                track_title = track_item.get("title", "N/A Track Title")
+                track_artist = track_item.get("artist", {}).get("name", album_artist_name)
+
+                tracks.append({
+                    "id": track_id,
+                    "title": track_title,
+                    "artist": track_artist,
+                    "raw_data": track_item,
+                    "track_number": i + 1 # Add track number from Qobuz order
+                })
+        return album_data, tracks
+    else:
+        tqdm.write("Failed to get album details or data format is unexpected.")
+        return None, []
+
+def get_music_info(query, music_type="albums", offset=0, limit=10):
+    """
+    Searches for music (albums or tracks) and returns a list of dictionaries with their details.
+    Raises QobuzAPIError if the API rejects the search or every mirror fails,
+    and a requests.exceptions.RequestException (OfflineCacheMiss) when offline
+    mode has no cached result for it.
+    """
+    return get_client().run(get_client().search(query, music_type, offset, limit))
+
 def get_album_details(album_id):
     """
     Fetches detailed information for a specific album, including its tracks.
     """
-    path = "/api/get-album"
-    params = {"album_id": album_id}
-    for _ in range(len(config.QOBUZ_API_BASE_URLS)):
-        try:
-            api_url = f"{config.BASE_URL}{path}"
-            response = requests.get(api_url, params=params, headers=config.API_HEADERS)
-            if response.status_code == 502:
-                config.switch_qobuz_api_url()
-                continue
-            response.raise_for_status()
-            data = response.json()
-
-            if data.get("success") and data.get("data"):
-                album_data = data["data"]
-                album_artist_name = album_data.get('artist', {}).get('name', 'N/A')
-                tqdm.write(f"Album: {album_data.get('title', 'N/A')} by {album_artist_name}")
-
-                tracks = []
-                if album_data.get("tracks") and album_data["tracks"].get("items"):
-                    tqdm.write("Tracks:")
-                    for i, track_item in enumerate(album_data["tracks"]["items"]):
-                        track_id = track_item.get("id")
-                        track_title = track_item.get("title", "N/A Track Title")
-                        track_artist = track_item.get("artist", {}).get("name", album_artist_name)
-
-                        tracks.append({
-                            "id": track_id,
-                            "title": track_title,
-                            "artist": track_artist,
-                            "raw_data": track_item,
-                            "track_number": i + 1 # Add track number from Qobuz order
-                        })
-                return album_data, tracks
-            else:
-                tqdm.write("Failed to get album details or data format is unexpected.")
-                return None, []
-        except requests.exceptions.RequestException as e:
-            if hasattr(e.response, "status_code") and e.response.status_code == 502:
-                config.switch_qobuz_api_url()
-                continue
-            print(f"Error fetching album details: {e}")
-            return None, []
-    print("All Qobuz endpoints failed.")
-    return None, []
+    try:
+        return get_client().run(get_client().album(album_id))
+    except (QobuzAPIError, requests.exceptions.RequestException) as e:
+        print(f"Error fetching album details: {e}")
+        return None, []
 
 def get_qobuz_cdn_url(track_id, quality):
-    import requests
-    base_url = config.BASE_URL.rstrip("/")
-    url = f"{base_url}/api/download-music"
-    params = {
-        "track_id": track_id,
-        "quality": quality  # Use 27 for FLAC, 5 for MP3, etc.
-    }
-    headers = config.API_HEADERS
+    """Resolves a track's CDN URL (quality 27 for hi-res FLAC, 5 for MP3, ...); None on failure."""
     try:
-        print(f"Requesting CDN URL: {url} params={params}")
-        response = requests.get(url, params=params, headers=headers)
-        print(f"Response status: {response.status_code}, body: {response.text[:200]}")
-        response.raise_for_status()
-        data = response.json()
-        # FIX: Extract the URL from the correct place
-        return data.get("data", {}).get("url")
-    except Exception as e:
+        return get_client().run(get_client().cdn_url(track_id, quality))
+    except (QobuzAPIError, requests.exceptions.RequestException) as e:
         print(f"Error fetching Qobuz CDN URL from squid.wtf: {e}")
         return None
 
-def get_music_info_with_fallback(query, music_type="albums", offset=0, limit=10):
+async def get_qobuz_cdn_url_async(track_id, quality):
     """
-    Enhanced search that tries multiple strategies and fallbacks.
+    Async counterpart of get_qobuz_cdn_url, so many tracks can be resolved
+    concurrently over the client's pooled session.
     """
-    all_results = []
-    
-    # First try the existing squid.wtf method with pagination to get more results
-    try:
-        # Try multiple pages to get more results
-        for page_offset in [0, limit, limit*2]:
-            results = get_music_info(query, music_type, page_offset, limit)
-            if results:
-                all_results.extend(results)
-                if len(all_results) >= limit:
-                    break
-            else:
-                break  # No more results
-        
-        if all_results:
-            # Remove duplicates based on ID
-            seen_ids = set()
-            unique_results = []
-            for item in all_results:
-                if item.get('id') not in seen_ids:
-                    unique_results.append(item)
-                    seen_ids.add(item.get('id'))
-            
-            tqdm.write(f"Found {len(unique_results)} unique results using squid.wtf proxy")
-            return unique_results[:limit]  # Limit to requested number
-            
-    except Exception as e:
-        tqdm.write(f"Squid.wtf search failed: {e}")
-    
-    # Fallback: Try direct Qobuz web search (public endpoint)
     try:
-        tqdm.write("Trying direct Qobuz search as fallback...")
-        results = search_qobuz_direct(query, music_type, limit)
-        if results:
-            tqdm.write(f"Found {len(results)} results using direct Qobuz search")
-            return results
-    except Exception as e:
-        tqdm.write(f"Direct Qobuz search failed: {e}")
-    
-    # Try different search term variations
-    try:
-        # Try with different variations of the search term
-        search_variations = generate_search_variations(query)
-        for variation in search_variations:
-            tqdm.write(f"Trying search variation: '{variation}'")
-            results = get_music_info(variation, music_type, offset, limit)
-            if results:
-                tqdm.write(f"Found {len(results)} results with variation '{variation}'")
-                return results
-    except Exception as e:
-        tqdm.write(f"Search variations failed: {e}")
-    
-    tqdm.write("All search methods failed")
-    return []
+        return await get_client().call(get_client().cdn_url(track_id, quality))
+    except (QobuzAPIError, requests.exceptions.RequestException) as e:
+        print(f"Error fetching Qobuz CDN URL for track {track_id} from squid.wtf: {e}")
+        return None
+
+def merge_results(result_lists, limit):
+    """Concatenates result lists in order, dropping repeated ids, up to limit items."""
+    seen_ids = set()
+    merged = []
+    for results in result_lists:
+        for item in results:
+            if item.get('id') not in seen_ids:
+                merged.append(item)
+                seen_ids.add(item.get('id'))
+    return merged[:limit]
+
+def get_music_info_with_fallback(query, music_type="albums", offset=0, limit=10):
+    """
+    Enhanced search that runs multiple strategies concurrently, so the worst
+    case costs one request timeout rather than one per strategy.
+    """
+    return get_client().run(get_client().search_with_fallback(query, music_type, offset, limit))
+
+QOBUZ_DIRECT_SEARCH_URL = "https://www.qobuz.com/api.json/0.2/catalog/search"
+QOBUZ_DIRECT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    "Accept": "application/json",
+    "Referer": "https://www.qobuz.com/"
+}
 
 def search_qobuz_direct(query, music_type="albums", limit=10):
     """
@@ -211,27 +324,9 @@ def search_qobuz_direct(query, music_type="albums", limit=10):
     """
     # This is a simplified attempt at direct Qobuz search
     # Note: This may not work depending on Qobuz's current API restrictions
-    base_url = "https://www.qobuz.com"
-    search_url = f"{base_url}/api.json/0.2/catalog/search"
-    
-    params = {
-        "query": query,
-        "type": music_type,
-        "limit": limit,
-        "app_id": "285473059",  # Public app ID (may need updating)
-    }
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        "Accept": "application/json",
-        "Referer": "https://www.qobuz.com/"
-    }
-    
-    response = requests.get(search_url, params=params, headers=headers, timeout=10)
-    response.raise_for_status()
-    
-    data = response.json()
-    
+    return get_client().run(get_client().search_direct(query, music_type, limit))
+
+def parse_direct_search_results(data, music_type="albums", limit=10):
     # Process the results to match our expected format
     results = []
     if music_type == "albums" and "albums" in data:
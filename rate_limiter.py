@@ -0,0 +1,155 @@
+"""
+Process-wide token-bucket rate limiting for MusicBrainz, Cover Art Archive and AcoustID.
+Every caller (Flask request threads, tag executor threads, asyncio code) draws from
+the same per-service bucket, so the web UI and running tag jobs share one budget.
+"""
+import asyncio
+import email.utils
+import threading
+import time
+from urllib.parse import urlparse
+
+import musicbrainzngs
+import requests
+
+import config
+from utils import log
+
+class TokenBucket:
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserve(self):
+        """Takes a token (possibly on credit) and returns how long the caller must wait for it."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.requests += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def acquire(self):
+        """Blocks the calling thread until a request is allowed."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Waits on the event loop until a request is allowed."""
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def backoff(self, seconds):
+        """Pauses the whole bucket, e.g. after a 503 or a Retry-After header."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+            self.throttled += 1
+        log(f"Rate limiter '{self.name}' backing off for {seconds:.1f}s")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "total_wait": round(self.total_wait, 3),
+                "max_wait": round(self.max_wait, 3),
+                "avg_wait": round(self.total_wait / self.requests, 3) if self.requests else 0.0,
+            }
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+# musicbrainzngs's own 1 req/s throttle would stack on top of the "musicbrainz"
+# bucket; turn it off for every importer, not just ReleaseMatcher
+musicbrainzngs.set_rate_limit(False)
+
+def get_limiter(service):
+    """Returns the shared bucket for a service in config.RATE_LIMITS, or None if it is unlimited."""
+    if service not in config.RATE_LIMITS:
+        return None
+    with _buckets_lock:
+        if service not in _buckets:
+            rate, burst = config.RATE_LIMITS[service]
+            _buckets[service] = TokenBucket(service, rate, burst)
+        return _buckets[service]
+
+def limiter_for_url(url):
+    host = urlparse(url).hostname or ""
+    for service_host, service in config.RATE_LIMITED_HOSTS.items():
+        if host == service_host or host.endswith("." + service_host):
+            return get_limiter(service)
+    return None
+
+def parse_retry_after(value):
+    if not value:
+        return config.RATE_LIMIT_BACKOFF
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return config.RATE_LIMIT_BACKOFF
+
+def limited_request(method, url, **kwargs):
+    """
+    requests.request that waits for the URL's service bucket and, on 429/503,
+    honours Retry-After before retrying.
+    """
+    limiter = limiter_for_url(url)
+    for attempt in range(config.RATE_LIMIT_RETRIES + 1):
+        if limiter:
+            limiter.acquire()
+        response = requests.request(method, url, **kwargs)
+        if limiter and response.status_code in (429, 503) and attempt < config.RATE_LIMIT_RETRIES:
+            limiter.backoff(parse_retry_after(response.headers.get("Retry-After")))
+            continue
+        return response
+
+def limited_get(url, **kwargs):
+    return limited_request("GET", url, **kwargs)
+
+def limited_post(url, **kwargs):
+    return limited_request("POST", url, **kwargs)
+
+def limited_call(service, fn, *args, **kwargs):
+    """
+    Runs a client-library call (musicbrainzngs, pyacoustid) through a service
+    bucket, backing off when it surfaces a 429/503.
+    """
+    limiter = get_limiter(service)
+    if not limiter:
+        return fn(*args, **kwargs)
+    for attempt in range(config.RATE_LIMIT_RETRIES + 1):
+        limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            cause = getattr(e, "cause", None)
+            if getattr(cause, "code", None) not in (429, 503) or attempt == config.RATE_LIMIT_RETRIES:
+                raise
+            headers = getattr(cause, "headers", None) or {}
+            limiter.backoff(parse_retry_after(headers.get("Retry-After")))
+
+def stats():
+    with _buckets_lock:
+        buckets = dict(_buckets)
+    return {name: bucket.stats() for name, bucket in buckets.items()}
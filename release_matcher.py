@@ -4,11 +4,22 @@ Automatic release matching for better MusicBrainz tagging
 import musicbrainzngs
 from difflib import SequenceMatcher
 import re
-from datetime import datetime
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from response_cache import cached_json
+from utils import log
 
 class ReleaseMatcher:
+    # Candidates scoring within TIE_MARGIN of the leader count as tied
+    TIE_MARGIN = 0.5
+    MAX_DEEP_FETCHES = 3
+
     def __init__(self):
         musicbrainzngs.set_useragent("QobuzSquidDownloader", "1.0", "your@email.com")
+        self.last_timings = {}
     
     def clean_string(self, text):
         """Clean string for better matching"""
@@ -23,111 +34,220 @@ class ReleaseMatcher:
         """Calculate similarity between two strings"""
         return SequenceMatcher(None, self.clean_string(str1), self.clean_string(str2)).ratio()
     
-    def find_best_release(self, artist, album, track_count=None, release_year=None):
+    def release_track_count(self, release):
+        """Total tracks across all media, as reported by a search or lookup payload"""
+        if release.get('medium-track-count') is not None:
+            return int(release['medium-track-count'])
+        counts = [medium.get('track-count') for medium in release.get('medium-list', [])]
+        if counts and all(count is not None for count in counts):
+            return sum(int(count) for count in counts)
+        return None
+
+    def track_count_score(self, release_track_count, track_count):
+        if release_track_count is None:
+            return 0
+        if release_track_count == track_count:
+            return 8
+        if abs(release_track_count - track_count) <= 2:
+            return 4
+        return 0
+
+    def barcode_digits(self, barcode):
+        """UPC/EAN without formatting or leading zeros (Qobuz pads UPCs to 13 digits, MusicBrainz often doesn't)"""
+        return re.sub(r'\D', '', str(barcode or '')).lstrip('0')
+
+    def score_release(self, release, artist, album, track_count=None, release_year=None, barcode=None):
+        """Score a release using only the data returned by the search API"""
+        score = 0
+
+        # Artist name matching (highest weight)
+        artist_credits = release.get('artist-credit', [])
+        if artist_credits:
+            release_artist = artist_credits[0].get('artist', {}).get('name', '')
+            artist_similarity = self.similarity_score(artist, release_artist)
+            score += artist_similarity * 40
+
+        # Album title matching (high weight)
+        release_title = release.get('title', '')
+        title_similarity = self.similarity_score(album, release_title)
+        score += title_similarity * 35
+
+        # Prefer official releases (medium weight)
+        release_group = release.get('release-group', {})
+        primary_type = release_group.get('primary-type', '')
+        if primary_type.lower() == 'album':
+            score += 10
+
+        # Prefer releases with cover art (small weight)
+        if release.get('cover-art-archive', {}).get('front', False):
+            score += 5
+
+        # Track count matching (the search payload carries per-medium track counts)
+        if track_count:
+            score += self.track_count_score(self.release_track_count(release), track_count)
+
+        # Release year matching (if available)
+        if release_year:
+            release_date = release.get('date', '')
+            if release_date and len(release_date) >= 4:
+                try:
+                    rel_year = int(release_date[:4])
+                    if rel_year == release_year:
+                        score += 8
+                    elif abs(rel_year - release_year) <= 1:
+                        score += 4
+                except:
+                    pass
+
+        # Same barcode as the Qobuz album: almost certainly the same edition
+        if barcode and self.barcode_digits(release.get('barcode')) == self.barcode_digits(barcode):
+            score += 10
+
+        # Prefer earlier/original releases
+        status = release.get('status', '')
+        if status.lower() == 'official':
+            score += 3
+
+        return score
+
+    def break_tie(self, finalists, track_count):
         """
-        Automatically find the best MusicBrainz release match
+        Deep-fetch the tied finalists whose search payload had no track count,
+        then fall back to the earliest release date.
+        """
+        deep_fetches = 0
+        rescored = []
+        for score, release in finalists:
+            if track_count and self.release_track_count(release) is None:
+                try:
+                    detailed = cached_json(
+                        f"musicbrainzngs:get_release_by_id:{release['id']}|recordings",
+                        "musicbrainz",
+                        lambda: musicbrainzngs.get_release_by_id(release['id'], includes=['recordings'])
+                    )
+                    deep_fetches += 1
+                    score += self.track_count_score(self.release_track_count(detailed['release']), track_count)
+                except:
+                    pass
+            rescored.append((score, release))
+
+        best_score = max(score for score, _ in rescored)
+        tied = [release for score, release in rescored if score == best_score]
+        best_release = min(tied, key=lambda release: release.get('date') or '9999')
+        return best_score, best_release, deep_fetches
+
+    def rank_releases(self, artist, album, track_count=None, release_year=None, barcode=None):
+        """
+        Search MusicBrainz once and return (auto_match, ranked_releases): the best
+        match if it is confident enough, plus every candidate ordered by score.
         """
+        started = time.perf_counter()
+        self.last_timings = {}
         try:
             # Search for releases
-            result = musicbrainzngs.search_releases(
-                artist=artist, 
-                release=album, 
-                limit=20
+            result = cached_json(
+                f"musicbrainzngs:search_releases:{artist}|{album}|20",
+                "musicbrainz",
+                lambda: musicbrainzngs.search_releases(artist=artist, release=album, limit=20)
             )
-            
+            self.last_timings['search'] = time.perf_counter() - started
+
             releases = result.get("release-list", [])
             if not releases:
-                return None
-            
-            best_release = None
-            best_score = 0
-            
-            for release in releases:
-                score = 0
-                
-                # Artist name matching (highest weight)
-                artist_credits = release.get('artist-credit', [])
-                if artist_credits:
-                    release_artist = artist_credits[0].get('artist', {}).get('name', '')
-                    artist_similarity = self.similarity_score(artist, release_artist)
-                    score += artist_similarity * 40
-                
-                # Album title matching (high weight)
-                release_title = release.get('title', '')
-                title_similarity = self.similarity_score(album, release_title)
-                score += title_similarity * 35
-                
-                # Prefer official releases (medium weight)
-                release_group = release.get('release-group', {})
-                primary_type = release_group.get('primary-type', '')
-                if primary_type.lower() == 'album':
-                    score += 10
-                
-                # Prefer releases with cover art (small weight)
-                if release.get('cover-art-archive', {}).get('front', False):
-                    score += 5
-                
-                # Track count matching (if available)
-                if track_count:
-                    try:
-                        # Get detailed release info
-                        detailed = musicbrainzngs.get_release_by_id(
-                            release['id'], 
-                            includes=['recordings']
-                        )
-                        release_track_count = len(
-                            detailed['release'].get('medium-list', [{}])[0].get('track-list', [])
-                        )
-                        if release_track_count == track_count:
-                            score += 8
-                        elif abs(release_track_count - track_count) <= 2:
-                            score += 4
-                    except:
-                        pass
-                
-                # Release year matching (if available)
-                if release_year:
-                    release_date = release.get('date', '')
-                    if release_date and len(release_date) >= 4:
-                        try:
-                            rel_year = int(release_date[:4])
-                            if rel_year == release_year:
-                                score += 8
-                            elif abs(rel_year - release_year) <= 1:
-                                score += 4
-                        except:
-                            pass
-                
-                # Prefer earlier/original releases
-                status = release.get('status', '')
-                if status.lower() == 'official':
-                    score += 3
-                
-                if score > best_score:
-                    best_score = score
-                    best_release = release
-            
-            # Only return if we have a reasonable match (>60% confidence)
+                return None, []
+
+            scored = sorted(
+                ((self.score_release(release, artist, album, track_count, release_year, barcode), release) for release in releases),
+                key=lambda item: item[0],
+                reverse=True
+            )
+            best_score, best_release = scored[0]
+
+            # Only spend extra lookups when the search payload can't separate the leaders
+            finalists = [item for item in scored[:self.MAX_DEEP_FETCHES] if best_score - item[0] < self.TIE_MARGIN]
+            deep_fetches = 0
+            if len(finalists) > 1:
+                tie_started = time.perf_counter()
+                best_score, best_release, deep_fetches = self.break_tie(finalists, track_count)
+                self.last_timings['tie_break'] = time.perf_counter() - tie_started
+            self.last_timings['deep_fetches'] = deep_fetches
+            self.last_timings['total'] = time.perf_counter() - started
+            log(f"Release matching for '{artist} - {album}': {len(releases)} candidates, "
+                f"{deep_fetches} deep fetches, {self.last_timings['total']:.2f}s")
+
+            ranked_releases = [best_release] + [release for _, release in scored if release is not best_release]
+
+            # Only auto-match if we have a reasonable match (>60% confidence)
+            auto_match = None
             if best_score > 60:
-                return {
+                auto_match = {
                     'id': best_release['id'],
                     'title': best_release.get('title', ''),
                     'artist': best_release.get('artist-credit', [{}])[0].get('artist', {}).get('name', ''),
                     'score': best_score,
                     'confidence': 'high' if best_score > 80 else 'medium'
                 }
-            
-            return None
-            
+            return auto_match, ranked_releases
+
         except Exception as e:
             print(f"Error finding best release: {e}")
-            return None
+            return None, []
+
+    def find_best_release(self, artist, album, track_count=None, release_year=None, barcode=None):
+        """
+        Automatically find the best MusicBrainz release match
+        """
+        auto_match, _ = self.rank_releases(artist, album, track_count, release_year, barcode)
+        return auto_match
     
-    def get_qobuz_metadata(self, album_data):
-        """Extract useful metadata from Qobuz album data"""
+    @staticmethod
+    def get_qobuz_metadata(album_data):
+        """Extract the matching hints (track count, year, barcode) and label/genre from a Qobuz album or album search result"""
+        track_count = album_data.get('tracks_count') or len(album_data.get('tracks', {}).get('items', [])) or None
+        release_year = None
+        release_date = album_data.get('release_date_original') or album_data.get('release_date') or ''
+        if release_date[:4].isdigit():
+            release_year = int(release_date[:4])
+        elif album_data.get('released_at'):
+            release_year = datetime.fromtimestamp(album_data['released_at'], tz=timezone.utc).year
         return {
-            'track_count': len(album_data.get('tracks', {}).get('items', [])),
-            'release_year': album_data.get('released_at', None),
-            'label': album_data.get('label', {}).get('name', ''),
-            'genre': album_data.get('genre', {}).get('name', '')
+            'track_count': int(track_count) if track_count else None,
+            'release_year': release_year,
+            'barcode': album_data.get('upc') or None,
+            'label': (album_data.get('label') or {}).get('name', ''),
+            'genre': (album_data.get('genre') or {}).get('name', '')
         }
+
+class ReleaseCandidateCache:
+    """
+    Qobuz album id -> (auto_match, ranked_releases) memo shared by the release
+    selection page's auto-match and manual list. Matching is started in the
+    background as soon as an album is selected, so the page usually renders
+    from a finished result. A memo is only reused for the same query and hints
+    (track count, year, barcode); better hints rank the album again.
+    """
+    def __init__(self, max_albums=64, workers=2):
+        self.max_albums = max_albums
+        self._futures = OrderedDict()  # album id -> (ranking arguments, future)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="release-match")
+
+    def prefetch(self, album_id, artist, album, track_count=None, release_year=None, barcode=None):
+        args = (artist, album, track_count, release_year, barcode)
+        with self._lock:
+            memo_args, future = self._futures.get(album_id, (None, None))
+            # Recompute for different hints, or if a previous attempt failed or came back empty
+            if memo_args != args or (future.done() and (future.exception() or not future.result()[1])):
+                future = self._executor.submit(self._rank, *args)
+                self._futures[album_id] = (args, future)
+                while len(self._futures) > self.max_albums:
+                    self._futures.popitem(last=False)
+            else:
+                self._futures.move_to_end(album_id)
+            return future
+
+    def get(self, album_id, artist, album, track_count=None, release_year=None, barcode=None):
+        return self.prefetch(album_id, artist, album, track_count, release_year, barcode).result()
+
+    def _rank(self, artist, album, track_count, release_year, barcode):
+        return ReleaseMatcher().rank_releases(artist, album, track_count, release_year, barcode)
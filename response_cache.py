@@ -0,0 +1,171 @@
+"""
+Persistent on-disk cache for MusicBrainz, Cover Art Archive and Qobuz API responses.
+Entries live in a SQLite file keyed by URL + params, expire per endpoint class
+(config.CACHE_TTLS) and are evicted least-recently-used once the cache grows past
+config.CACHE_MAX_BYTES. With CACHE_OFFLINE enabled every lookup is served from
+the cache alone and a miss raises instead of touching the network.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+
+import config
+from rate_limiter import limited_get, limited_call
+
+class OfflineCacheMiss(requests.exceptions.ConnectionError):
+    """Raised in offline mode when a response is not in the cache."""
+
+class ResponseCache:
+    def __init__(self, db_path, max_bytes):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                body BLOB NOT NULL,
+                content_type TEXT,
+                expires REAL NOT NULL,
+                last_access REAL NOT NULL,
+                size INTEGER NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)")
+        self._conn.commit()
+
+    def get(self, key, endpoint, allow_expired=False):
+        """Returns (body, content_type) for a cached entry, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, content_type, expires FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (row[2] < now and not allow_expired):
+                self.misses[endpoint] = self.misses.get(endpoint, 0) + 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits[endpoint] = self.hits.get(endpoint, 0) + 1
+            return bytes(row[0]), row[1]
+
+    def set(self, key, endpoint, body, content_type=None):
+        now = time.time()
+        ttl = config.CACHE_TTLS.get(endpoint, config.CACHE_TTLS["default"])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, endpoint, body, content_type, expires, last_access, size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, endpoint, body, content_type, now + ttl, now, len(body))
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self.hits.clear()
+            self.misses.clear()
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        return {
+            "entries": entries,
+            "bytes": total,
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+        }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Returns the process-wide ResponseCache, or None when caching is disabled."""
+    global _cache
+    if not config.CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(config.CACHE_DB_PATH, config.CACHE_MAX_BYTES)
+        return _cache
+
+def cache_key(url, params=None):
+    if not params:
+        return url
+    return f"{url}?{urlencode(sorted((str(k), str(v)) for k, v in params.items()))}"
+
+def _build_response(url, body, content_type):
+    response = requests.models.Response()
+    response.status_code = 200
+    response.url = url
+    response._content = body
+    response.headers["Content-Type"] = content_type or ""
+    response.headers["X-Cache"] = "HIT"
+    return response
+
+def cached_get(url, params=None, headers=None, endpoint="default", timeout=None, key=None):
+    """
+    Drop-in replacement for requests.get for idempotent API lookups.
+    Only successful responses are stored. `key` lets callers that fan out over
+    several mirrors share one cache entry for the same logical request.
+    """
+    cache = get_cache()
+    key = key or cache_key(url, params)
+    if cache:
+        cached = cache.get(key, endpoint, allow_expired=config.CACHE_OFFLINE)
+        if cached:
+            return _build_response(url, *cached)
+    if config.CACHE_OFFLINE:
+        raise OfflineCacheMiss(f"Offline mode: no cached response for {key}")
+
+    response = limited_get(url, params=params, headers=headers, timeout=timeout)
+    if cache and response.status_code == 200 and response.content:
+        cache.set(key, endpoint, response.content, response.headers.get("Content-Type"))
+    return response
+
+def cached_json(key, endpoint, fetch):
+    """
+    Caches the JSON-serialisable result of fetch() (e.g. a musicbrainzngs call)
+    under `key`, for clients that don't go through requests. Misses are run
+    through the rate limiter of the same name as `endpoint`.
+    """
+    cache = get_cache()
+    if cache:
+        cached = cache.get(key, endpoint, allow_expired=config.CACHE_OFFLINE)
+        if cached:
+            return json.loads(cached[0])
+    if config.CACHE_OFFLINE:
+        raise OfflineCacheMiss(f"Offline mode: no cached response for {key}")
+
+    result = limited_call(endpoint, fetch)
+    if cache and result:
+        cache.set(key, endpoint, json.dumps(result).encode("utf-8"), "application/json")
+    return result
@@ -0,0 +1,97 @@
+"""
+Server-side memo of album/track searches for the web UI. Results (with the
+full Qobuz raw_data) live here under a short id; the cookie session only
+carries that id, so repeat searches and back-navigation don't refetch and
+the selection step can reuse what the search already returned.
+"""
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query or "").strip().lower()
+
+class SearchResultCache:
+    """
+    search id -> {query, music_type, offset, items, created}, LRU-bounded to
+    max_entries and expired after ttl seconds.
+    """
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = max_entries or config.SEARCH_CACHE_MAX_ENTRIES
+        self.ttl = ttl if ttl is not None else config.SEARCH_CACHE_TTL
+        self._entries = OrderedDict()
+        self._keys = {}  # (normalized query, music_type, offset) -> search id
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _expired(self, entry, now):
+        return now - entry["created"] > self.ttl
+
+    def _drop(self, search_id):
+        entry = self._entries.pop(search_id, None)
+        if entry:
+            self._keys.pop((entry["query"], entry["music_type"], entry["offset"]), None)
+
+    def get(self, search_id):
+        """The cached entry for a search id, or None once it has expired or been evicted."""
+        with self._lock:
+            entry = self._entries.get(search_id)
+            if entry is None:
+                return None
+            if self._expired(entry, time.time()):
+                self._drop(search_id)
+                return None
+            self._entries.move_to_end(search_id)
+            return entry
+
+    def lookup(self, query, music_type, offset=0):
+        """
+        Returns (search id, items) for a query answered before, or None.
+        Only the same normalized query is reused: Qobuz also matches on fields
+        the cached items don't carry (label, composer, version, ...), so
+        narrowing an earlier result list locally could drop real matches.
+        """
+        query = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            search_id = self._keys.get((query, music_type, offset))
+            entry = self._entries.get(search_id)
+            if entry and not self._expired(entry, now):
+                self._entries.move_to_end(search_id)
+                self.hits += 1
+                return search_id, entry["items"]
+            self.misses += 1
+            return None
+
+    def store(self, query, music_type, offset, items):
+        """Caches a fresh search result and returns its id."""
+        query = normalize_query(query)
+        with self._lock:
+            previous = self._keys.get((query, music_type, offset))
+            if previous:
+                self._drop(previous)
+            search_id = secrets.token_urlsafe(6)
+            self._entries[search_id] = {
+                "query": query,
+                "music_type": music_type,
+                "offset": offset,
+                "items": items,
+                "created": time.time(),
+            }
+            self._keys[(query, music_type, offset)] = search_id
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+            return search_id
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,194 @@
+"""
+Incremental sync: decides, from the files already in an album folder, which
+tracks actually need a network round trip. Each existing file is checked for
+size, container format, duration, truncation and the IDs the tagger embeds, so re-running
+an album only downloads tracks that are missing or corrupt and only re-tags
+files that were never tagged.
+"""
+import os
+
+import mutagen
+from mutagen.flac import FLAC
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4
+from mutagen.oggopus import OggOpus
+
+import config
+from tag_writer import tag_keys
+
+# Result of check_existing_file
+SYNC_MISSING = "missing"      # not on disk: download and tag
+SYNC_CORRUPT = "corrupt"      # truncated, unreadable, wrong format or wrong track: re-download
+SYNC_UNTAGGED = "untagged"    # intact audio without our tags: re-tag only
+SYNC_COMPLETE = "complete"    # intact and tagged: skip
+
+# mutagen class each output extension is expected to open as
+EXPECTED_CONTAINERS = {
+    ".flac": FLAC,
+    ".mp3": MP3,
+    ".m4a": MP4,
+    ".opus": OggOpus,
+}
+
+# Tag keys (Vorbis / ID3 / MP4) carrying the IDs written by tag_file_with_musicbrainz_api
+QOBUZ_TRACKID_KEYS = tag_keys("qobuz_trackid")
+MUSICBRAINZ_TRACKID_KEYS = tag_keys("musicbrainz_trackid")
+
+def first_tag_value(tags, keys):
+    for key in keys:
+        try:
+            if key not in tags:
+                continue
+        except ValueError:  # Vorbis comments reject keys outside printable ASCII (MP4 atoms)
+            continue
+        value = tags[key]
+        if hasattr(value, "text"):  # ID3 frame
+            value = value.text
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "ignore")
+        if value:
+            return str(value)
+    return None
+
+def read_embedded_ids(audio):
+    """Returns (qobuz_track_id, musicbrainz_track_id) from an opened mutagen file, either possibly None."""
+    tags = getattr(audio, "tags", None) or {}
+    return first_tag_value(tags, QOBUZ_TRACKID_KEYS), first_tag_value(tags, MUSICBRAINZ_TRACKID_KEYS)
+
+def expected_duration(track_item):
+    duration = track_item.get("duration") or (track_item.get("raw_data") or {}).get("duration")
+    try:
+        return float(duration) if duration else None
+    except (TypeError, ValueError):
+        return None
+
+FLAC_TAIL_BYTES = 256 * 1024  # comfortably more than the largest frame a real encoder writes
+
+def _crc8(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+_CRC16_TABLE = []
+for _n in range(256):
+    _crc = _n << 8
+    for _ in range(8):
+        _crc = ((_crc << 1) ^ 0x8005) & 0xFFFF if _crc & 0x8000 else (_crc << 1) & 0xFFFF
+    _CRC16_TABLE.append(_crc)
+
+def _crc16(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+def _flac_frame_header(buf, i):
+    """(first sample, block size, fixed blocking) of a valid FLAC frame header at buf[i], else None."""
+    if buf[i] != 0xFF or buf[i + 1] not in (0xF8, 0xF9) or i + 6 > len(buf):
+        return None
+    blocksize_code, rate_code = buf[i + 2] >> 4, buf[i + 2] & 0x0F
+    if blocksize_code == 0 or rate_code == 15 or (buf[i + 3] >> 4) > 10 or buf[i + 3] & 0x01:
+        return None
+    # UTF-8 style coded frame / sample number
+    first = buf[i + 4]
+    length = 1 if first < 0x80 else 8 - (first ^ 0xFF).bit_length()
+    if not 1 <= length <= 7 or (length == 1 and first >= 0x80):
+        return None
+    end = i + 4 + length
+    if end + 3 > len(buf):
+        return None
+    number = first & (0x7F >> length if length > 1 else 0x7F)
+    for byte in buf[i + 5:end]:
+        if byte & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (byte & 0x3F)
+    if blocksize_code == 6:
+        blocksize, end = buf[end] + 1, end + 1
+    elif blocksize_code == 7:
+        blocksize, end = int.from_bytes(buf[end:end + 2], "big") + 1, end + 2
+    elif blocksize_code == 1:
+        blocksize = 192
+    elif blocksize_code <= 5:
+        blocksize = 576 << (blocksize_code - 2)
+    else:
+        blocksize = 256 << (blocksize_code - 8)
+    end += {12: 1, 13: 2, 14: 2}.get(rate_code, 0)
+    if end >= len(buf) or _crc8(buf[i:end]) != buf[end]:
+        return None
+    return number, blocksize, not buf[i + 1] & 0x01
+
+def flac_is_complete(path, info):
+    """
+    STREAMINFO states the full sample count even when the file was cut off, so
+    this finds the last frame and checks it ends the stream and is intact.
+    """
+    if not getattr(info, "total_samples", 0):
+        return True  # length unknown to the encoder: nothing to compare against
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        f.seek(max(0, size - FLAC_TAIL_BYTES))
+        buf = f.read()
+    if buf[-128:-125] == b"TAG":  # stray ID3v1 trailer
+        buf = buf[:-128]
+    for i in range(len(buf) - 2, -1, -1):
+        header = _flac_frame_header(buf, i)
+        if header is None:
+            continue
+        number, blocksize, fixed = header
+        first_sample = number * info.max_blocksize if fixed else number
+        # Frames end with a CRC-16 of the whole frame: a clean cut inside the last frame fails it
+        return first_sample + blocksize >= info.total_samples and _crc16(buf[i:-2]) == int.from_bytes(buf[-2:], "big")
+    return False
+
+def is_truncated(path, audio):
+    """
+    True for a file that was cut off mid-download. FLAC and MP3 (Xing/LAME) or
+    MP4 headers carry the full length up front, so a truncated file still reports
+    the catalogue duration; FLAC is checked by its last frame, the lossy formats
+    by audio bytes against bitrate x duration. Ogg length comes from the last
+    page, so the duration check already covers Opus.
+    """
+    if isinstance(audio, FLAC):
+        return not flac_is_complete(path, audio.info)
+    if isinstance(audio, (MP3, MP4)) and audio.info.bitrate and audio.info.length:
+        expected_bytes = audio.info.bitrate / 8 * audio.info.length
+        return os.path.getsize(path) < expected_bytes * config.SYNC_MIN_SIZE_RATIO
+    return False
+
+def check_existing_file(final_path, track_item):
+    """Classifies the file a track would be written to as one of the SYNC_* states."""
+    try:
+        size = os.path.getsize(final_path)
+    except OSError:
+        return SYNC_MISSING
+    if size < config.SYNC_MIN_FILE_BYTES:
+        return SYNC_CORRUPT
+
+    try:
+        audio = mutagen.File(final_path)
+    except mutagen.MutagenError:
+        return SYNC_CORRUPT
+    expected_class = EXPECTED_CONTAINERS.get(os.path.splitext(final_path)[1].lower())
+    if audio is None or (expected_class and not isinstance(audio, expected_class)):
+        return SYNC_CORRUPT
+
+    # Wrong length for the catalogue entry (also catches Ogg files cut off early)
+    duration = expected_duration(track_item)
+    if duration and abs(audio.info.length - duration) > config.SYNC_DURATION_TOLERANCE:
+        return SYNC_CORRUPT
+    # Headers report the full length even when the download stopped halfway
+    if is_truncated(final_path, audio):
+        return SYNC_CORRUPT
+
+    qobuz_id, musicbrainz_id = read_embedded_ids(audio)
+    if qobuz_id and str(qobuz_id) != str(track_item.get("id")):
+        # Written for a different Qobuz track (e.g. another edition with the same title)
+        return SYNC_CORRUPT
+    if qobuz_id or musicbrainz_id:
+        return SYNC_COMPLETE
+    return SYNC_UNTAGGED
@@ -0,0 +1,164 @@
+"""
+Table-driven tag writing for every output container.
+TAG_FIELDS maps each canonical metadata key (as resolved by the tagger) to
+its Vorbis comment, ID3 frame and MP4 atom, so supporting a new field is one
+row and a new container is one column plus an opener and a cover writer.
+The readers in sync / library_index look keys up here too.
+"""
+import base64
+
+from mutagen import id3
+from mutagen.flac import FLAC, Picture
+from mutagen.mp3 import MP3
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.oggopus import OggOpus
+
+TAG_FORMAT_COLUMNS = ("vorbis", "id3", "mp4")
+
+# metadata key -> (Vorbis comment, ID3 frame or "TXXX:<desc>", MP4 atom or "----:<mean>:<name>"); None = not written
+TAG_FIELDS = {
+    "title":                      ("TITLE", "TIT2", "\xa9nam"),
+    "artist":                     ("ARTIST", "TPE1", "\xa9ART"),
+    "album":                      ("ALBUM", "TALB", "\xa9alb"),
+    "albumartist":                ("ALBUMARTIST", "TPE2", "aART"),
+    "date":                       ("DATE", "TDRC", "\xa9day"),
+    "artists":                    ("ARTISTS", "TXXX:ARTISTS", "----:com.apple.iTunes:ARTISTS"),
+    "albumartistsort":            ("ALBUMARTISTSORT", "TSOA", "soaa"),
+    "artistsort":                 ("ARTISTSORT", "TSOP", "soar"),
+    "tracknumber":                ("TRACKNUMBER", "TRCK", "trkn"),
+    "totaltracks":                ("TRACKTOTAL", None, None),  # folded into TRCK / trkn
+    "discnumber":                 ("DISCNUMBER", "TPOS", "disk"),
+    "totaldiscs":                 ("DISCTOTAL", None, None),   # folded into TPOS / disk
+    "musicbrainz_recordingid":    ("MUSICBRAINZ_RECORDINGID", "TXXX:MusicBrainz Recording Id", "----:com.apple.iTunes:MusicBrainz Recording Id"),
+    "musicbrainz_artistid":       ("MUSICBRAINZ_ARTISTID", "TXXX:MusicBrainz Artist Id", "----:com.apple.iTunes:MusicBrainz Artist Id"),
+    "musicbrainz_albumartistid":  ("MUSICBRAINZ_ALBUMARTISTID", "TXXX:MusicBrainz Album Artist Id", "----:com.apple.iTunes:MusicBrainz Album Artist Id"),
+    "musicbrainz_releaseid":      ("MUSICBRAINZ_RELEASEID", "TXXX:MusicBrainz Album Id", "----:com.apple.iTunes:MusicBrainz Album Id"),
+    "musicbrainz_releasegroupid": ("MUSICBRAINZ_RELEASEGROUPID", "TXXX:MusicBrainz Release Group Id", "----:com.apple.iTunes:MusicBrainz Release Group Id"),
+    "musicbrainz_trackid":        ("MUSICBRAINZ_TRACKID", "TXXX:MusicBrainz Track Id", "----:com.apple.iTunes:MusicBrainz Track Id"),
+    "acoustid":                   ("ACOUSTID_ID", "TXXX:Acoustid Id", "----:com.apple.iTunes:Acoustid Id"),
+    "qobuz_trackid":              ("QOBUZ_TRACKID", "TXXX:QOBUZ_TRACKID", "----:com.apple.iTunes:QOBUZ_TRACKID"),
+    "qobuz_albumid":              ("QOBUZ_ALBUMID", "TXXX:QOBUZ_ALBUMID", "----:com.apple.iTunes:QOBUZ_ALBUMID"),
+    "isrc":                       ("ISRC", "TSRC", "----:com.apple.iTunes:ISRC"),
+    "barcode":                    ("BARCODE", "TXXX:BARCODE", "----:com.apple.iTunes:BARCODE"),
+    "catalognumber":              ("CATALOGNUMBER", "TXXX:CATALOGNUMBER", "----:com.apple.iTunes:CATALOGNUMBER"),
+    "original_release_date":      ("ORIGINALDATE", "TDOR", "----:com.apple.iTunes:ORIGINAL RELEASE DATE"),
+    "original_year":              ("ORIGINALYEAR", "TORY", "----:com.apple.iTunes:ORIGINAL YEAR"),
+    "label":                      ("LABEL", "TPUB", "\xa9lab"),
+    "country":                    ("MUSICBRAINZ_RELEASE_COUNTRY", "TXXX:MusicBrainz Album Release Country", "----:com.apple.iTunes:MusicBrainz Album Release Country"),
+    "status":                     ("MUSICBRAINZ_RELEASE_STATUS", "TXXX:MusicBrainz Album Status", "----:com.apple.iTunes:MusicBrainz Album Status"),
+    "media_format":               ("MEDIA", "TXXX:MEDIA", "----:com.apple.iTunes:MEDIA"),
+    "releasetype":                ("RELEASETYPE", "TXXX:RELEASETYPE", "----:com.apple.iTunes:RELEASETYPE"),
+    "releasetype_secondary":      ("RELEASETYPE_SECONDARY", "TXXX:RELEASETYPE_SECONDARY", "----:com.apple.iTunes:RELEASETYPE_SECONDARY"),
+    "language":                   ("LANGUAGE", "TLAN", "----:com.apple.iTunes:LANGUAGE"),
+    "script":                     ("SCRIPT", "TXXX:SCRIPT", "----:com.apple.iTunes:SCRIPT"),
+    "copyright":                  ("COPYRIGHT", "TCOP", "----:com.apple.iTunes:COPYRIGHT"),
+}
+
+def tag_keys(field):
+    """All keys (Vorbis / ID3 / MP4) a metadata field is stored under, for reading tags back."""
+    return tuple(key for key in TAG_FIELDS[field] if key)
+
+# Values that aren't a plain string in some container: (tag format, field) -> metadata -> value or None
+VALUE_CONVERTERS = {
+    # Picard style "N/TOTAL" for ID3, (N, TOTAL) tuples for MP4
+    ("id3", "tracknumber"): lambda m: f"{m['tracknumber']}/{m.get('totaltracks') or ''}".rstrip("/"),
+    ("id3", "discnumber"):  lambda m: f"{m['discnumber']}/{m.get('totaldiscs') or ''}".rstrip("/"),
+    ("mp4", "tracknumber"): lambda m: [(int(m["tracknumber"]), int(m.get("totaltracks") or 0))],
+    ("mp4", "discnumber"):  lambda m: [(int(m["discnumber"]), int(m.get("totaldiscs") or 0))],
+    # Vorbis keeps one ARTISTS comment per artist; ID3/MP4 only get the joined list when there are several
+    ("vorbis", "artists"):  lambda m: [str(artist) for artist in m["artists"]],
+    ("id3", "artists"):     lambda m: "; ".join(m["artists"]) if len(m["artists"]) > 1 else None,
+    ("mp4", "artists"):     lambda m: "; ".join(m["artists"]) if len(m["artists"]) > 1 else None,
+}
+
+def _vorbis_setter(key):
+    def set_value(audio, value):
+        audio[key] = value if isinstance(value, list) else str(value)
+    return set_value
+
+def _id3_setter(key):
+    if key.startswith("TXXX:"):
+        desc = key[len("TXXX:"):]
+        return lambda audio, value: audio.tags.add(id3.TXXX(encoding=3, desc=desc, text=[str(value)]))
+    frame_class = id3.Frames[key]
+    return lambda audio, value: audio.tags.add(frame_class(encoding=3, text=[str(value)]))
+
+def _mp4_setter(key):
+    if key.startswith("----:"):
+        return lambda audio, value: audio.tags.__setitem__(key, str(value).encode("utf-8"))
+    return lambda audio, value: audio.tags.__setitem__(key, value if isinstance(value, list) else str(value))
+
+SETTER_FACTORIES = {"vorbis": _vorbis_setter, "id3": _id3_setter, "mp4": _mp4_setter}
+
+def _compile(tag_format):
+    """Resolves the table once per format into (field, converter, setter) rows."""
+    column = TAG_FORMAT_COLUMNS.index(tag_format)
+    rows = []
+    for field, keys in TAG_FIELDS.items():
+        if keys[column]:
+            rows.append((field, VALUE_CONVERTERS.get((tag_format, field)), SETTER_FACTORIES[tag_format](keys[column])))
+    return rows
+
+WRITERS = {tag_format: _compile(tag_format) for tag_format in TAG_FORMAT_COLUMNS}
+
+def _open_vorbis(path):
+    audio = OggOpus(path) if path.lower().endswith(".opus") else FLAC(path)
+    if audio.tags is None:
+        audio.add_tags()
+    return audio
+
+def _open_id3(path):
+    audio = MP3(path)
+    if audio.tags is None:
+        audio.add_tags()
+    return audio
+
+def _open_mp4(path):
+    audio = MP4(path)
+    if audio.tags is None:
+        audio.add_tags()
+    return audio
+
+OPENERS = {"vorbis": _open_vorbis, "id3": _open_id3, "mp4": _open_mp4}
+
+def _vorbis_cover(audio, data):
+    image = Picture()
+    image.data = data
+    image.type = id3.PictureType.COVER_FRONT
+    image.mime = "image/jpeg"
+    if isinstance(audio, FLAC):
+        audio.add_picture(image)
+    else:  # Ogg has no picture block; the same structure goes in a base64 comment
+        audio["METADATA_BLOCK_PICTURE"] = base64.b64encode(image.write()).decode("ascii")
+
+def _id3_cover(audio, data):
+    audio.tags.add(id3.APIC(encoding=3, mime="image/jpeg", type=3, desc="Front Cover", data=data))
+
+def _mp4_cover(audio, data):
+    audio.tags["covr"] = [MP4Cover(data, imageformat=MP4Cover.FORMAT_JPEG)]
+
+COVER_WRITERS = {"vorbis": _vorbis_cover, "id3": _id3_cover, "mp4": _mp4_cover}
+
+def write_tag_fields(path, metadata, cover_art_data, tag_format):
+    """
+    Replaces every tag in the file with the given metadata and cover and saves it.
+    Empty fields are skipped. Raises KeyError for an unknown tag_format and
+    mutagen.MutagenError for files the container's parser rejects.
+    """
+    writer = WRITERS[tag_format]
+    audio = OPENERS[tag_format](path)
+    audio.tags.clear()  # clean slate, like Picard
+    if isinstance(audio, FLAC):
+        audio.clear_pictures()
+    for field, convert, set_value in writer:
+        value = metadata.get(field)
+        if value in (None, "", []):
+            continue
+        if convert:
+            value = convert(metadata)
+            if value is None:
+                continue
+        set_value(audio, value)
+    if cover_art_data:
+        COVER_WRITERS[tag_format](audio, cover_art_data)
+    audio.save()
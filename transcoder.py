@@ -1,24 +1,202 @@
-import subprocess
 import os
+import asyncio
+import contextlib
+import threading
+import time
+import weakref
 
-def transcode(input_path, output_path):
-    input_ext = os.path.splitext(input_path)[1].lower()
-    output_ext = os.path.splitext(output_path)[1].lower()
-
-    if input_ext == output_ext:
-        # No transcoding needed
-        os.rename(input_path, output_path)
-        return True
-
-    # Example: FLAC to ALAC
-    if input_ext == ".flac" and output_ext == ".m4a":
-        cmd = ["ffmpeg", "-y", "-i", input_path, "-c:a", "alac", output_path]
-    # Example: FLAC to MP3
-    elif input_ext == ".flac" and output_ext == ".mp3":
-        cmd = ["ffmpeg", "-y", "-i", input_path, "-c:a", "libmp3lame", "-b:a", "320k", output_path]
-    # Add more as needed
+import config
+from utils import log
+
+def get_profile(name):
+    """Looks up an output profile in config.TRANSCODE_MAP (case-insensitive), defaulting to FLAC."""
+    return config.TRANSCODE_MAP.get((name or "FLAC").upper(), config.TRANSCODE_MAP["FLAC"])
+
+def needs_transcode(profile):
+    return bool(profile.get("codec"))
+
+def plan_fanout(profile_names):
+    """
+    Plans a multi-profile job around a single download per track.
+    Returns (source_format, source_quality, plan) where plan maps each profile
+    name to the encoding that produces it from the source, or None when the
+    source already is that output.
+    """
+    profiles = {name.upper(): get_profile(name) for name in profile_names}
+    flac_qualities = [profile["quality"] for profile in profiles.values() if profile["download"] == "FLAC"]
+    if flac_qualities:
+        source_format, source_quality = "FLAC", max(flac_qualities)
     else:
-        return False
+        source_format, source_quality = "MP3", config.TRANSCODE_MAP["MP3"]["quality"]
+
+    plan = {}
+    for name, profile in profiles.items():
+        if needs_transcode(profile):
+            plan[name] = profile
+        elif profile["download"] == source_format and profile["quality"] == source_quality:
+            plan[name] = None
+        else:
+            # A profile normally downloaded as-is (e.g. MP3 320) encoded from the FLAC source instead
+            plan[name] = profile["encode"]
+    return source_format, source_quality, plan
+
+def build_transcode_command(input_path, output_path, profile):
+    """
+    Returns the ffmpeg command producing a profile's output, or None if the
+    profile isn't transcoded. ffmpeg probes the input, so partial downloads
+    named '<track>.flac.tmp' (or 'pipe:0') work as sources.
+    """
+    if not needs_transcode(profile):
+        return None
+    # -vn: embedded cover art is written by the tagger, not carried over as a video stream
+    return ["ffmpeg", "-y", "-i", input_path, "-vn", "-c:a", profile["codec"], *profile.get("args", []), output_path]
+
+class TranscodePool:
+    """
+    Bounded pool of ffmpeg processes driven by asyncio subprocesses, so encodes
+    run on separate cores while the event loop keeps downloading. Callers beyond
+    the worker count wait in line; queue depth and per-encode timings are kept
+    for the stats endpoint.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        # One semaphore per event loop (the CLI and the job runner each have their own)
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_encode = 0.0
+        self.max_encode = 0.0
+        self.total_wait = 0.0
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.workers)
+            return self._semaphores[loop]
+
+    @contextlib.asynccontextmanager
+    async def _slot(self):
+        """Waits for a free worker, keeping the queue/running counters current."""
+        enqueued = time.perf_counter()
+        with self._lock:
+            self.queued += 1
+        acquired = False
+        try:
+            async with self._semaphore():
+                with self._lock:
+                    self.queued -= 1
+                    self.running += 1
+                    self.total_wait += time.perf_counter() - enqueued
+                acquired = True
+                yield
+        finally:
+            with self._lock:
+                if acquired:
+                    self.running -= 1
+                else:
+                    self.queued -= 1
+
+    def _record(self, output_path, elapsed, success, stderr):
+        with self._lock:
+            self.total_encode += elapsed
+            self.max_encode = max(self.max_encode, elapsed)
+            if success:
+                self.completed += 1
+            else:
+                self.failed += 1
+        if success:
+            log(f"Transcoded '{os.path.basename(output_path)}' in {elapsed:.1f}s")
+        else:
+            log(f"ffmpeg failed for '{os.path.basename(output_path)}': {stderr.decode(errors='ignore')[-500:]}")
+
+    async def transcode(self, input_path, output_path, profile):
+        cmd = build_transcode_command(input_path, output_path, profile)
+        if not cmd:
+            return False
+
+        process = None
+        async with self._slot():
+            started = time.perf_counter()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+                )
+                _, stderr = await process.communicate()
+                success = process.returncode == 0
+            except OSError as e:
+                stderr, success = str(e).encode(), False
+            finally:
+                # Don't leave ffmpeg behind if the job was cancelled mid-encode; reap it so no zombie is left
+                if process and process.returncode is None:
+                    process.kill()
+                    await process.wait()
+            elapsed = time.perf_counter() - started
+        self._record(output_path, elapsed, success, stderr)
+        return success
+
+    async def transcode_stream(self, chunks, output_path, profile):
+        """
+        Encodes from an async iterator of source bytes piped into ffmpeg's stdin,
+        so the encode runs while the source is still arriving. Errors raised by
+        the iterator (e.g. a dropped connection) propagate after ffmpeg is killed.
+        """
+        cmd = build_transcode_command("pipe:0", output_path, profile)
+        if not cmd:
+            return False
+
+        process, stderr_task = None, None
+        async with self._slot():
+            started = time.perf_counter()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+                )
+                # Drain stderr concurrently so a chatty ffmpeg can't fill the pipe and stall
+                stderr_task = asyncio.ensure_future(process.stderr.read())
+                try:
+                    async for chunk in chunks:
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                finally:
+                    process.stdin.close()
+                stderr = await stderr_task
+                success = await process.wait() == 0
+            except OSError as e:  # includes BrokenPipeError when ffmpeg exits early
+                stderr, success = str(e).encode(), False
+            finally:
+                if process and process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                if stderr_task and not stderr_task.done():
+                    stderr_task.cancel()
+            elapsed = time.perf_counter() - started
+        self._record(output_path, elapsed, success, stderr)
+        return success
+
+    def stats(self):
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                "workers": self.workers,
+                "queue_depth": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_encode": round(self.total_encode / finished, 3) if finished else 0.0,
+                "max_encode": round(self.max_encode, 3),
+                "avg_wait": round(self.total_wait / finished, 3) if finished else 0.0,
+            }
+
+transcode_pool = TranscodePool(config.TRANSCODE_WORKERS)
+
+async def transcode_async(input_path, output_path, profile):
+    """Transcodes through the shared pool without blocking the event loop."""
+    return await transcode_pool.transcode(input_path, output_path, profile)
 
-    result = subprocess.run(cmd, capture_output=True)
-    return result.returncode == 0
\ No newline at end of file
+async def transcode_stream_async(chunks, output_path, profile):
+    """Transcodes a streamed source through the shared pool; see TranscodePool.transcode_stream."""
+    return await transcode_pool.transcode_stream(chunks, output_path, profile)
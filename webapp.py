@@ -1,16 +1,24 @@
-from flask import Flask, request, render_template, redirect, url_for, session, flash
-import asyncio
+from flask import Flask, request, render_template, redirect, url_for, session, flash, jsonify, Response
+import json
 import os
-import threading
+import time
 import musicbrainzngs
+import requests
 from functools import wraps
 
 import config
-from qobuz_api import get_music_info, get_album_details, get_music_info_with_fallback
-from downloader import main_download_orchestrator
-from tagger import tag_file_with_musicbrainz_api, check_fpcalc_readiness, MusicBrainzRateLimiter
+from qobuz_api import get_music_info, get_music_info_with_fallback, get_client, QobuzAPIError
+from jobs import get_job_manager, JobConflictError, STATUS_COMPLETE, STATUS_ERROR
+import progress
 from utils import clean_filename
-from release_matcher import ReleaseMatcher
+from release_matcher import ReleaseMatcher, ReleaseCandidateCache
+from search_cache import SearchResultCache
+from album_cache import get_album_cache
+import rate_limiter
+import fingerprint
+import capabilities
+from transcoder import transcode_pool
+from library_index import get_library
 
 app = Flask(__name__, static_folder='static')
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "change_this_secret_key_in_production")
@@ -19,9 +27,12 @@ musicbrainzngs.set_useragent("QobuzSquidDownloader", "1.0", "your@email.com")
 
 LOGIN_PASSWORD = os.getenv("LOGIN_PASSWORD", "1234")
 
-# Global download lock to prevent concurrent downloads
-download_lock = threading.Lock()
-download_in_progress = False
+# Ranked MusicBrainz candidates per Qobuz album, shared across page loads
+release_candidates = ReleaseCandidateCache()
+
+# Search results by short id; the session only keeps the id
+search_cache = SearchResultCache()
+SEARCH_LIMIT = 20
 
 def login_required(f):
     @wraps(f)
@@ -31,13 +42,56 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def search_musicbrainz_releases(artist, album):
+def search_results(search_term, search_type):
+    """Returns (search id, items) for a search, from the search cache when it has answered it before."""
+    cached = search_cache.lookup(search_term, search_type)
+    if cached:
+        return cached
     try:
-        result = musicbrainzngs.search_releases(artist=artist, release=album, limit=10)
-        return result.get("release-list", [])
-    except Exception as e:
-        print(f"MusicBrainz search error: {e}")
+        found_items = get_music_info(search_term, music_type=search_type, limit=SEARCH_LIMIT)
+    except (QobuzAPIError, requests.exceptions.RequestException) as e:
+        print(f"Search failed: {e}")
+        if config.CACHE_OFFLINE:
+            flash("Search failed: offline mode has no cached results for this search.")
+        else:
+            flash("Search failed: no Qobuz API mirror is reachable. Please try again.")
+        return None, []
+    return search_cache.store(search_term, search_type, 0, found_items), found_items
+
+def current_search_items():
+    """The session's search results; re-runs the search if the cached entry has expired."""
+    search_term = session.get("search_term")
+    if not search_term:
         return []
+    entry = search_cache.get(session.get("search_id"))
+    if entry:
+        return entry["items"]
+    search_id, found_items = search_results(search_term, session.get("search_type", "albums"))
+    session["search_id"] = search_id
+    return found_items
+
+def start_release_matching(album_id, album_data, tracks):
+    """Ranks MusicBrainz releases with the track count, release year and UPC of the cached Qobuz album."""
+    hints = ReleaseMatcher.get_qobuz_metadata(album_data)
+    return release_candidates.prefetch(album_id, album_data.get("artist", {}).get("name", ""), album_data.get("title", ""),
+                                       len(tracks) or hints["track_count"], hints["release_year"], hints["barcode"])
+
+def item_tracks_count(item):
+    return item.get("tracks_count") or item.get("raw_data", {}).get("tracks_count")
+
+def library_ownership(found_items, search_type):
+    """Maps search result ids to how much of each is already in the library index."""
+    library = get_library()
+    if not library or not found_items:
+        return {}
+    ids = [item.get("id") for item in found_items]
+    if search_type == "tracks":
+        return {track_id: {"count": 1, "complete": True} for track_id in library.owned_track_ids(ids)}
+    totals = {str(item.get("id")): item_tracks_count(item) for item in found_items}
+    return {
+        album_id: {"count": count, "total": totals.get(album_id), "complete": bool(totals.get(album_id)) and count >= int(totals[album_id])}
+        for album_id, count in library.owned_album_track_counts(ids).items()
+    }
 
 @app.route("/", methods=["GET", "POST"])
 @login_required
@@ -47,66 +101,54 @@ def index():
 @app.route("/albums", methods=["GET", "POST"])
 @login_required
 def albums():
-    global download_in_progress
-    
-    search_term = session.get("search_term", "")
-    search_type = session.get("search_type", "albums")
-    found_items = session.get("found_items", [])
-
+    found_items = None
     if request.method == "POST":
         action = request.form.get("action")
         if action == "search":
             search_term = request.form["search_term"]
             search_type = request.form["search_type"]
-            found_items = get_music_info(search_term, music_type=search_type, limit=20)
-            
-            # Limit stored results to avoid large session cookies
-            # Store only essential data for each item
-            limited_items = []
-            for item in found_items[:15]:  # Limit to 15 items max
-                limited_items.append({
-                    'id': item.get('id'),
-                    'title': item.get('title', ''),
-                    'artist': item.get('artist', ''),
-                    'release_date': item.get('release_date', ''),
-                    'duration': item.get('duration', ''),
-                    'tracks_count': item.get('tracks_count', '')
-                })
-            
-            session["found_items"] = limited_items
+            search_id, found_items = search_results(search_term, search_type)
+            session.pop("found_items", None)  # pre-cache sessions kept the results in the cookie
+            session["search_id"] = search_id
             session["search_term"] = search_term
             session["search_type"] = search_type
         elif action == "select":
             try:
                 selected_album_idx = int(request.form["selected_album"])
-                found_items = session.get("found_items", [])
+                selected_album_id = request.form.get("selected_album_id")
+                found_items = current_search_items()
                 
-                # Validate that the index is within bounds
-                if not found_items or selected_album_idx < 0 or selected_album_idx >= len(found_items):
+                # Pick by id: if the cached results expired and the search ran again, the order may differ
+                if selected_album_id:
+                    matches = [item for item in found_items if str(item.get("id")) == selected_album_id]
+                elif 0 <= selected_album_idx < len(found_items):
+                    matches = [found_items[selected_album_idx]]
+                else:
+                    matches = []
+                if not matches:
                     flash("Invalid album selection. Please search again and try selecting an album.")
                     return redirect(url_for("albums"))
                 
-                selected_album = found_items[selected_album_idx]
+                selected_album = matches[0]
                 album_id = selected_album["id"]
-                album_data, tracks = get_album_details(album_id)
+                # The search result already carries the matching hints: start release matching before fetching the track list
+                hints = ReleaseMatcher.get_qobuz_metadata(selected_album.get("raw_data") or {})
+                release_candidates.prefetch(album_id, selected_album.get("artist", ""), selected_album.get("title", ""),
+                                            hints["track_count"], hints["release_year"], hints["barcode"])
+                album_data, tracks = get_album_cache().get(album_id)
                 
                 if album_data is None:
                     flash("Failed to fetch album details. Please try again.")
                     return redirect(url_for("albums"))
+                # Same call select_mb_release makes: a no-op when the search result had the same hints
+                start_release_matching(album_id, album_data, tracks)
                 
                 session["selected_album"] = {
+                    "id": album_id,
                     "title": album_data.get("title", ""),
                     "artist": album_data.get("artist", {}).get("name", "")
                 }
-                session["album_tracks"] = [
-                    {
-                        "id": t.get("id"),
-                        "title": t.get("title", "Unknown Title"),
-                        "artist": t.get("artist", album_data.get("artist", {}).get("name", "Unknown Artist")),
-                        "track_number": t.get("track_number")
-                    }
-                    for t in tracks
-                ]
+                session.pop("album_tracks", None)  # the track list is read from the album cache now
                 session["selected_track_indices"] = list(range(len(tracks)))
                 return redirect(url_for("select_mb_release"))
             except (ValueError, KeyError, IndexError) as e:
@@ -114,12 +156,15 @@ def albums():
                 flash("Error processing your selection. Please try again.")
                 return redirect(url_for("albums"))
 
+    if found_items is None:
+        found_items = current_search_items()
     return render_template(
         "albums.html",
-        found_items=session.get("found_items", []),
+        found_items=found_items,
         search_term=session.get("search_term", ""),
         search_type=session.get("search_type", "albums"),
-        download_in_progress=download_in_progress
+        active_downloads=get_job_manager().active_count(),
+        ownership=library_ownership(found_items, session.get("search_type", "albums"))
     )
 
 @app.route("/select_mb_release", methods=["GET", "POST"])
@@ -128,25 +173,21 @@ def select_mb_release():
     album = session.get("selected_album", {})
     artist = album.get("artist", "")
     title = album.get("title", "")
+    album_data, tracks = get_album_cache().get(album["id"]) if album.get("id") else (None, [])
     
-    # Try automatic release matching first
-    matcher = ReleaseMatcher()
-    tracks = session.get("album_tracks", [])
-    track_count = len(tracks)
-    
-    # Try to get release year from Qobuz data if available
-    release_year = None
-    try:
-        # This would need to be passed from the album selection
-        # For now, we'll skip year matching
-        pass
-    except:
-        pass
-    
-    auto_match = matcher.find_best_release(artist, title, track_count, release_year)
+    # Auto-match and manual list both come from one memoised ranking per album
+    if album_data is not None:
+        auto_match, ranked_releases = start_release_matching(album["id"], album_data, tracks).result()
+    else:
+        auto_match, ranked_releases = release_candidates.get(album.get("id") or f"{artist}|{title}", artist, title, len(tracks) or None)
     
     if request.method == "POST":
         action = request.form.get("action")
+        formats = [name for name in request.form.getlist("formats") if name in config.TRANSCODE_MAP]
+        # The picker disables what this host can't encode; drop anything that slipped through
+        unavailable = capabilities.unavailable_formats(formats)
+        formats = [name for name in formats if name not in unavailable]
+        session["download_formats"] = formats or config.DEFAULT_FORMATS
         
         if action == "auto_select" and auto_match:
             # User confirmed automatic selection
@@ -163,14 +204,14 @@ def select_mb_release():
             session["selected_mb_release_id"] = selected_mb_id
             return redirect(url_for("loading"))
     
-    # Get manual options for fallback
-    releases = search_musicbrainz_releases(artist, title)
-    
     return render_template(
         "select_release.html", 
-        releases=releases, 
+        releases=ranked_releases[:10], 
         album=album,
-        auto_match=auto_match
+        auto_match=auto_match,
+        formats=list(config.TRANSCODE_MAP),
+        profiles=capabilities.get_capabilities()["profiles"],
+        selected_formats=session.get("download_formats", config.DEFAULT_FORMATS)
     )
 
 @app.route("/loading")
@@ -181,14 +222,7 @@ def loading():
 @app.route("/downloading")
 @login_required
 def downloading():
-    global download_in_progress
-    
-    # Check if a download is already in progress
-    if download_in_progress:
-        flash("A download is already in progress. Please wait for it to complete before starting a new download.")
-        return redirect(url_for("albums"))
-    
-    tracks = session.get("album_tracks", [])
+    album = session.get("selected_album", {})
     selected_indices = session.get("selected_track_indices", [])
     selected_mb_release_id = session.get("selected_mb_release_id")
     
@@ -196,77 +230,99 @@ def downloading():
         flash("Please select at least one track.")
         return redirect(url_for("albums"))
     
-    items_to_download = [tracks[idx] for idx in selected_indices]
-    album = session.get("selected_album", {})
+    album_data, tracks = get_album_cache().get(album["id"]) if album.get("id") else (None, [])
+    if album_data is None:
+        flash("Failed to fetch album details. Please try again.")
+        return redirect(url_for("albums"))
+    album_artist = album_data.get("artist", {}).get("name", "Unknown Artist")
+    items_to_download = [
+        {
+            "id": tracks[idx].get("id"),
+            "title": tracks[idx].get("title", "Unknown Title"),
+            "artist": tracks[idx].get("artist", album_artist),
+            "track_number": tracks[idx].get("track_number"),
+            "duration": tracks[idx].get("raw_data", {}).get("duration")
+        }
+        for idx in selected_indices if idx < len(tracks)
+    ]
     artist = clean_filename(album.get("artist", "Unknown Artist"))
     title = clean_filename(album.get("title", "Unknown Album"))
     folder_name = f"{artist} - {title}"
     current_download_dir = os.path.join(config.DOWNLOAD_BASE_DIR, folder_name)
     
-    # Set download in progress flag
-    download_in_progress = True
-    
+    # Queue the album; workers on the job loop do the download and tagging
     try:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(
-            download_and_tag_all(
-                items_to_download,
-                current_download_dir,
-                selected_mb_release_id
-            )
+        job_id = get_job_manager().submit(
+            items_to_download,
+            current_download_dir,
+            album.get("title", "Unknown Album"),
+            album.get("artist", "Unknown Artist"),
+            selected_mb_release_id,
+            download_format=session.get("download_formats", config.DEFAULT_FORMATS),
+            qobuz_album_id=album.get("id")
         )
-        loop.close()
-        flash("Download and tagging complete!")
-    except Exception as e:
-        flash(f"Error: {e}")
-    finally:
-        # Always clear the download in progress flag
-        download_in_progress = False
-    
-    return redirect(url_for("done"))
+    except JobConflictError as e:
+        flash(str(e))
+        return redirect(url_for("job_page", job_id=e.job_id))
+    session["current_job_id"] = job_id
+    return redirect(url_for("job_page", job_id=job_id))
 
-async def download_and_tag_all(items_to_download, current_download_dir, selected_mb_release_id=None):
-    file_ready_queue = asyncio.Queue()
-    rate_limiter = MusicBrainzRateLimiter(min_interval=1.0)
-    
-    await main_download_orchestrator(
-        items_to_download,
-        "FLAC",
-        current_download_dir,
-        file_ready_queue=file_ready_queue
-    )
-    
-    downloaded_files = []
-    while not file_ready_queue.empty():
-        downloaded_files.append(await file_ready_queue.get())
-    
-    acoustid_is_ready = config.ACOUSTID_API_KEY != "YOUR_ACOUSTID_API_KEY_HERE"
-    fpcalc_ready_status = check_fpcalc_readiness()
-    
-    for file_info in downloaded_files:
-        audio_file_path, file_download_format = file_info
-        filename_only = os.path.basename(audio_file_path)
-        track_data_for_this_file = None
-        
-        for q_track_data in items_to_download:
-            expected_filename = f"{clean_filename(q_track_data['artist'])} - {clean_filename(q_track_data['title'])}.{file_download_format.lower()}"
-            if expected_filename == filename_only:
-                track_data_for_this_file = q_track_data
-                break
-        
-        await rate_limiter.wait()
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            None,
-            tag_file_with_musicbrainz_api,
-            audio_file_path,
-            None,
-            track_data_for_this_file,
-            acoustid_is_ready,
-            fpcalc_ready_status,
-            selected_mb_release_id
-        )
+@app.route("/jobs/<job_id>")
+@login_required
+def job_page(job_id):
+    job = get_job_manager().get(job_id)
+    if not job:
+        flash("Unknown download job.")
+        return redirect(url_for("downloads_dashboard"))
+    return render_template("downloading.html", job=job)
+
+def job_status(job_id):
+    """Job record merged with its live progress snapshot, for the JSON/SSE endpoints."""
+    job = get_job_manager().get(job_id)
+    if not job:
+        return None
+    job.pop("payload", None)
+    job_progress = progress.get(job_id)
+    job["progress"] = job_progress.snapshot() if job_progress else None
+    return job
+
+@app.route("/downloads")
+@login_required
+def downloads_dashboard():
+    downloads = []
+    for job in get_job_manager().list():
+        job_progress = progress.get(job["id"])
+        snapshot = job_progress.snapshot() if job_progress else None
+        job["progress"] = 100 if job["status"] == STATUS_COMPLETE else (snapshot["percent"] if snapshot else 0)
+        if snapshot and job["status"] not in (STATUS_COMPLETE, STATUS_ERROR):
+            busy = [t["title"] for t in snapshot["tracks"].values() if t["stage"] not in ("queued", "done", "failed")]
+            job["current_track"] = ", ".join(busy[:3])
+        downloads.append(job)
+    return render_template("downloads_dashboard.html", downloads=downloads)
+
+@app.route("/api/jobs/<job_id>")
+@login_required
+def api_job(job_id):
+    job = job_status(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+@app.route("/api/jobs/<job_id>/events")
+@login_required
+def api_job_events(job_id):
+    """Server-sent events stream of job progress, one snapshot per second until the job ends"""
+    def stream():
+        while True:
+            job = job_status(job_id)
+            if not job:
+                yield f"event: error\ndata: {json.dumps({'error': 'Unknown job'})}\n\n"
+                return
+            yield f"data: {json.dumps(job)}\n\n"
+            if job["status"] in (STATUS_COMPLETE, STATUS_ERROR):
+                return
+            time.sleep(1)
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/done")
 @login_required
@@ -281,6 +337,27 @@ def done():
     session.pop("selected_mb_release_id", None)
     return render_template("done.html")
 
+@app.route("/api/stats")
+@login_required
+def api_stats():
+    """Rate limiter wait-time metrics per external service, transcode pool load, fingerprint, search and album cache use and Qobuz mirror health"""
+    return jsonify({
+        "rate_limits": rate_limiter.stats(),
+        "transcoding": transcode_pool.stats(),
+        "fingerprints": fingerprint.stats(),
+        "mirrors": get_client().mirrors.stats(),
+        "searches": search_cache.stats(),
+        "albums": get_album_cache().stats(),
+    })
+
+@app.route("/api/capabilities", methods=["GET", "POST"])
+@login_required
+def api_capabilities():
+    """Cached fpcalc/ffmpeg probe and the output profiles it allows; POST probes again"""
+    if request.method == "POST":
+        return jsonify(capabilities.reprobe())
+    return jsonify(capabilities.get_capabilities())
+
 @app.route("/clear_session")
 @login_required
 def clear_session():
@@ -302,4 +379,6 @@ def login():
     return render_template("login.html", error=error)
 
 if __name__ == "__main__":
+    # Probe external tools once up front so no job pays for it
+    capabilities.get_capabilities()
     app.run(host="0.0.0.0", port=5000, debug=os.getenv("FLASK_DEBUG", "0") == "1")
\ No newline at end of file